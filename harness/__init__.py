@@ -0,0 +1,17 @@
+"""
+In-process harness that runs the initializer and processor lambdas against in-memory AWS stand-ins.
+Used to measure throughput locally without deploying the stack or calling a real bot.
+"""
+
+from harness.fakes import FakeFirehose, FakeLambda, FakeLex, FakeS3, FakeSQS
+from harness.runner import LocalPipeline, RunStats
+
+__all__ = [
+    'FakeFirehose',
+    'FakeLambda',
+    'FakeLex',
+    'FakeS3',
+    'FakeSQS',
+    'LocalPipeline',
+    'RunStats',
+]
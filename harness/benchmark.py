@@ -0,0 +1,113 @@
+"""
+Benchmark the pipeline locally on synthetic suites.
+
+Usage:
+    python -m harness.benchmark --cases 10 1000 100000 --latency-ms 2 --concurrency 10
+
+Reports cases per second, p50/p99 step latency (as measured by the processor) and peak memory
+for each suite size. --min-cases-per-second and --max-p99-ms make it exit non-zero on a regression.
+"""
+
+import argparse
+import csv
+import io
+import logging
+import os
+import random
+import sys
+
+from harness.fakes import FakeLex, lognormal_latency
+from harness.runner import LocalPipeline, RunStats
+
+COLUMNS = [
+    'test_case',
+    'step',
+    'utterance',
+    'session_attributes',
+    'expected_response',
+    'expected_intent',
+    'expected_state',
+    'bot_id',
+    'alias_id',
+    'locale_id',
+]
+
+INTENTS = ['GreetingIntent', 'OrderPamphletIntent', 'CheckStatusIntent', 'TransferIntent', 'GoodbyeIntent']
+
+
+def synthetic_csv(cases: int, max_steps: int = 5, seed: int = 0) -> str:
+    """Build a suite of `cases` conversations with 1 to max_steps steps each"""
+    rng = random.Random(seed)
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=COLUMNS)
+    writer.writeheader()
+    for test_case in range(1, cases + 1):
+        for step in range(1, rng.randint(1, max_steps) + 1):
+            intent = rng.choice(INTENTS)
+            writer.writerow({
+                'test_case': test_case,
+                'step': step,
+                'utterance': f'utterance {test_case}.{step} for {intent}',
+                'session_attributes': 'channel=benchmark,' if step == 1 else '',
+                'expected_response': '',
+                'expected_intent': intent,
+                'expected_state': 'Fulfilled',
+                'bot_id': 'BENCHMARKBOT',
+                'alias_id': 'TSTALIASID',
+                'locale_id': 'en_US',
+            })
+    return output.getvalue()
+
+
+def run_benchmark(cases: int, args: argparse.Namespace) -> RunStats:
+    lex = FakeLex(
+        latency=lognormal_latency(args.latency_ms / 1000, args.latency_sigma),
+        throttle_rate=args.throttle_rate,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    content = synthetic_csv(cases, args.max_steps, args.seed)
+    with LocalPipeline(lex=lex, concurrency=args.concurrency) as pipeline:
+        return pipeline.run(content, name=f'benchmark-{cases}.csv', trace_memory=args.trace_memory)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the Lex test pipeline against a fake Lex runtime')
+    parser.add_argument('--cases', type=int, nargs='+', default=[10, 1000, 10000, 100000], help='suite sizes to run')
+    parser.add_argument('--max-steps', type=int, default=5, help='steps per conversation are drawn from 1..max')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent processor invocations')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='median fake Lex latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='spread of the lognormal latency')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of Lex calls throttled')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of Lex calls failing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='trace_memory', action='store_false', help='skip tracemalloc (it slows the run)')
+    parser.add_argument('--min-cases-per-second', type=float, help='fail if any run is slower than this')
+    parser.add_argument('--max-p99-ms', type=float, help='fail if any run has a higher p99 step latency')
+    args = parser.parse_args(argv)
+
+    # the lambdas log every step at DEBUG, which would dominate the measurement
+    os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+    logging.getLogger('lambdas').setLevel(logging.WARNING)
+
+    print(f'{"cases":>8} {"steps":>8} {"messages":>8} {"seconds":>8} {"cases/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"peak MiB":>9}')
+    regressions = []
+    for cases in args.cases:
+        stats = run_benchmark(cases, args)
+        peak = f'{stats.peak_memory_bytes / 2**20:9.1f}' if stats.peak_memory_bytes is not None else f'{"-":>9}'
+        print(
+            f'{stats.cases:>8} {stats.steps:>8} {stats.messages:>8} {stats.duration_seconds:>8.2f} '
+            f'{stats.cases_per_second:>10.1f} {stats.p50_step_latency_ms:>8.1f} {stats.p99_step_latency_ms:>8.1f} {peak}'
+        )
+        if args.min_cases_per_second is not None and stats.cases_per_second < args.min_cases_per_second:
+            regressions.append(f'{cases} cases: {stats.cases_per_second:.1f} cases/s < {args.min_cases_per_second}')
+        if args.max_p99_ms is not None and stats.p99_step_latency_ms > args.max_p99_ms:
+            regressions.append(f'{cases} cases: p99 {stats.p99_step_latency_ms:.1f} ms > {args.max_p99_ms}')
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""
+In-memory stand-ins for the AWS clients used by the lambdas.
+Only the calls (and response fields) the lambdas rely on are implemented.
+"""
+
+import io
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Optional
+
+from botocore.exceptions import ClientError
+
+
+def _client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def queue_arn(queue_url: str) -> str:
+    """The ARN of a queue given its url, https://sqs.<region>.amazonaws.com/<account>/<name>"""
+    host, account, name = queue_url.split('//', 1)[1].split('/')
+    return f"arn:aws:sqs:{host.split('.')[1]}:{account}:{name}"
+
+
+class FakeS3:
+    """Objects kept in a dict keyed by (bucket, key), multipart uploads keyed by upload id"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.parts_uploaded = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body=b'', **kwargs) -> dict:
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+        version_id = uuid.uuid4().hex
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if (kwargs.get('IfNoneMatch') == '*' and current is not None) or \
+                    ('IfMatch' in kwargs and (current is None or current['ETag'] != kwargs['IfMatch'])):
+                raise _client_error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold', 'PutObject')
+            self.objects[(Bucket, Key)] = {'Body': Body, 'ETag': etag, 'VersionId': version_id, 'Metadata': kwargs.get('Metadata', {})}
+        return {'ETag': etag, 'VersionId': version_id}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> dict:
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body=b'', **kwargs) -> dict:
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = (etag, Body)
+            self.parts_uploaded += 1
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict, **kwargs) -> dict:
+        with self._lock:
+            uploaded = self.uploads.pop(UploadId)
+        parts = MultipartUpload['Parts']
+        if [part['ETag'] for part in parts] != [uploaded[part['PartNumber']][0] for part in parts]:
+            raise _client_error('InvalidPart', 'One or more of the specified parts could not be found.', 'CompleteMultipartUpload')
+        return self.put_object(Bucket=Bucket, Key=Key, Body=b''.join(uploaded[part['PartNumber']][1] for part in parts))
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs) -> dict:
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', **kwargs) -> dict:
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key} for key in keys], 'KeyCount': len(keys), 'IsTruncated': False}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        response = self.get_object(Bucket=Bucket, Key=Key)
+        del response['Body']
+        return response
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        with self._lock:
+            obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise _client_error('NoSuchKey', 'The specified key does not exist.', 'GetObject')
+        return {
+            'Body': io.BytesIO(obj['Body']),
+            'ContentLength': len(obj['Body']),
+            'ETag': obj['ETag'],
+            'VersionId': obj['VersionId'],
+            'Metadata': obj['Metadata'],
+        }
+
+
+class FakeSQS:
+    """Queues kept in memory keyed by queue url.
+
+    receive() plays the part of the Lambda event source mapping and returns messages in the
+    shape of SQS event records. Received messages stay in flight until deleted or released.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.in_flight = {}
+        self.sent = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl: str, MessageBody: str, **kwargs) -> dict:
+        message = {
+            'messageId': str(uuid.uuid4()),
+            'body': MessageBody,
+            'messageAttributes': kwargs.get('MessageAttributes', {}),
+            'receiveCount': 0,
+        }
+        with self._lock:
+            self.queues.setdefault(QueueUrl, deque()).append(message)
+            self.sent += 1
+        return {'MessageId': message['messageId']}
+
+    def send_message_batch(self, QueueUrl: str, Entries: list[dict]) -> dict:
+        successful = []
+        for entry in Entries:
+            kwargs = {k: v for k, v in entry.items() if k not in ('Id', 'MessageBody')}
+            response = self.send_message(QueueUrl=QueueUrl, MessageBody=entry['MessageBody'], **kwargs)
+            successful.append({'Id': entry['Id'], 'MessageId': response['MessageId']})
+        return {'Successful': successful, 'Failed': []}
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str) -> dict:
+        with self._lock:
+            if self.in_flight.pop(ReceiptHandle, None) is not None:
+                self.deleted += 1
+        return {}
+
+    def receive(self, queue_url: str, max_messages: int = 1) -> list[dict]:
+        """Take up to max_messages off the queue as SQS event records"""
+        records = []
+        with self._lock:
+            queue = self.queues.get(queue_url, deque())
+            while queue and len(records) < max_messages:
+                message = queue.popleft()
+                message['receiveCount'] += 1
+                receipt_handle = uuid.uuid4().hex
+                self.in_flight[receipt_handle] = (queue_url, message)
+                records.append({
+                    'messageId': message['messageId'],
+                    'receiptHandle': receipt_handle,
+                    'body': message['body'],
+                    'attributes': {'ApproximateReceiveCount': str(message['receiveCount'])},
+                    'messageAttributes': message['messageAttributes'],
+                    'eventSource': 'aws:sqs',
+                    'eventSourceARN': queue_arn(queue_url),
+                })
+        return records
+
+    def receive_message(self, QueueUrl: str, MaxNumberOfMessages: int = 1, **kwargs) -> dict:
+        """The ReceiveMessage API, message attributes are always returned"""
+        return {'Messages': [{
+            'MessageId': record['messageId'],
+            'ReceiptHandle': record['receiptHandle'],
+            'Body': record['body'],
+            'Attributes': {'ApproximateReceiveCount': record['attributes']['ApproximateReceiveCount']},
+            'MessageAttributes': record['messageAttributes'],
+        } for record in self.receive(QueueUrl, MaxNumberOfMessages)]}
+
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int) -> dict:
+        # only making a message visible again is simulated, in-flight messages never time out
+        if VisibilityTimeout == 0:
+            self.release(ReceiptHandle)
+        return {}
+
+    def release(self, receipt_handle: str, max_receives: Optional[int] = None, dead_letter_url: Optional[str] = None) -> Optional[dict]:
+        """Make an in-flight message visible again (as when its visibility timeout expires).
+        Messages already received max_receives times go to dead_letter_url instead (dropped without one),
+        like a queue's redrive policy.
+        """
+        with self._lock:
+            queue_url, message = self.in_flight.pop(receipt_handle, (None, None))
+            if message is not None and (max_receives is None or message['receiveCount'] < max_receives):
+                self.queues.setdefault(queue_url, deque()).append(message)
+            elif message is not None and dead_letter_url is not None:
+                self.queues.setdefault(dead_letter_url, deque()).append(dict(message, receiveCount=0))
+        return message
+
+    def depth(self, queue_url: str) -> int:
+        with self._lock:
+            return len(self.queues.get(queue_url, ()))
+
+
+class FakeFirehose:
+    """Keeps every delivered record in memory"""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def put_record(self, DeliveryStreamName: str, Record: dict) -> dict:
+        with self._lock:
+            self.records.append(Record['Data'])
+        return {'RecordId': uuid.uuid4().hex}
+
+    def put_record_batch(self, DeliveryStreamName: str, Records: list[dict]) -> dict:
+        with self._lock:
+            self.records.extend(record['Data'] for record in Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': uuid.uuid4().hex} for _ in Records]}
+
+
+class FakeLambda:
+    """Invokes registered handlers in-process, keyed by function name"""
+
+    def __init__(self, functions: Optional[dict] = None):
+        self.functions = functions or {}
+        self.invocations = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName: str, InvocationType: str = 'RequestResponse', Payload='{}') -> dict:
+        with self._lock:
+            self.invocations += 1
+        if FunctionName not in self.functions:
+            raise _client_error('ResourceNotFoundException', f'Function not found: {FunctionName}', 'Invoke')
+        try:
+            result = self.functions[FunctionName](json.loads(Payload), None)
+        except Exception as e:
+            payload = {'errorMessage': str(e), 'errorType': type(e).__name__}
+            return {'StatusCode': 200, 'FunctionError': 'Unhandled', 'Payload': io.BytesIO(json.dumps(payload).encode('utf-8'))}
+        return {'StatusCode': 200 if InvocationType == 'RequestResponse' else 202, 'Payload': io.BytesIO(json.dumps(result, default=str).encode('utf-8'))}
+
+
+def constant_latency(seconds: float) -> Callable[[random.Random], float]:
+    """Every Lex call takes the same time"""
+    return lambda rng: seconds
+
+
+def lognormal_latency(median: float, sigma: float = 0.5) -> Callable[[random.Random], float]:
+    """Right-skewed latency, closer to what a real bot with codehooks looks like"""
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class FakeLex:
+    """Stand-in for the lexv2-runtime client.
+
+    Parameters:
+        latency: Returns the latency (seconds) of one call given the fake's random generator.
+        time_scale: Multiplier applied before sleeping, 0 records latency without waiting.
+        throttle_rate: Fraction of calls rejected with ThrottlingException.
+        failure_rate: Fraction of calls failing with InternalFailureException.
+        max_concurrency: Calls beyond this many in flight are throttled (None for no limit).
+        intent_for: Maps the recognize_text kwargs to the recognized intent name.
+            Defaults to the 'expected-intent' session attribute, so every step passes.
+    """
+
+    def __init__(
+        self,
+        latency: Callable[[random.Random], float] = constant_latency(0.0),
+        time_scale: float = 1.0,
+        throttle_rate: float = 0.0,
+        failure_rate: float = 0.0,
+        max_concurrency: Optional[int] = None,
+        intent_for: Optional[Callable[[dict], str]] = None,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.time_scale = time_scale
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.max_concurrency = max_concurrency
+        self.intent_for = intent_for or (lambda kwargs: kwargs['sessionState']['sessionAttributes'].get('expected-intent', ''))
+        self.calls = 0
+        self.throttled = 0
+        self.failed = 0
+        self.latencies = [] # simulated seconds for every successful call
+        self._in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def recognize_text(self, **kwargs) -> dict:
+        with self._lock:
+            self.calls += 1
+            roll = self._rng.random()
+            latency = self.latency(self._rng)
+            too_busy = self.max_concurrency is not None and self._in_flight >= self.max_concurrency
+            if too_busy or roll < self.throttle_rate:
+                self.throttled += 1
+                raise _client_error('ThrottlingException', 'Rate exceeded', 'RecognizeText')
+            if roll < self.throttle_rate + self.failure_rate:
+                self.failed += 1
+                raise _client_error('InternalFailureException', 'Injected failure', 'RecognizeText')
+            self._in_flight += 1
+
+        try:
+            if self.time_scale:
+                time.sleep(latency * self.time_scale)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self.latencies.append(latency)
+
+        return self._response(kwargs)
+
+    def _response(self, kwargs: dict) -> dict:
+        session_attributes = dict(kwargs.get('sessionState', {}).get('sessionAttributes', {}))
+        intent_name = self.intent_for(kwargs)
+        expected_intent = session_attributes.get('expected-intent', '')
+        session_attributes.update({
+            'actual_intent': intent_name,
+            'actual_state': 'Fulfilled',
+            'test_result': 'Pass' if intent_name == expected_intent else 'Fail',
+            'test_explanation': '' if intent_name == expected_intent else f'expected {expected_intent}, got {intent_name}',
+        })
+        return {
+            'messages': [{'content': f'You said: {kwargs.get("text", "")}', 'contentType': 'PlainText'}],
+            'sessionState': {
+                'intent': {'name': intent_name, 'state': 'Fulfilled'},
+                'sessionAttributes': session_attributes,
+            },
+            'sessionId': kwargs.get('sessionId'),
+        }
@@ -0,0 +1,254 @@
+"""
+Wires lambdas/initializer and lambdas/processor together through the in-memory fakes.
+lambdas/differ and lambdas/redrive are wired to the same fakes, to compare local runs and
+redrive their dead-lettered messages.
+
+Example:
+    with LocalPipeline(lex=FakeLex(latency=lognormal_latency(0.3)), concurrency=10) as pipeline:
+        stats = pipeline.run(csv_content)
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from typing import Optional, Union
+from unittest.mock import patch
+
+from harness.fakes import FakeFirehose, FakeLambda, FakeLex, FakeS3, FakeSQS
+
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/lex-analytics-test-queue'
+DLQ_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/lex-analytics-test-dlq'
+FIREHOSE_NAME = 'lex-analytics-results-firehose'
+PROCESSOR_FUNCTION_NAME = 'lex-analytics-processor'
+
+
+def lane_url(bot_id: str) -> str:
+    """The queue of a bot's lane, named like the stack names it"""
+    return f'{QUEUE_URL}-{bot_id.lower()}'
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile, 0 for an empty list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+@dataclass
+class RunStats:
+    """What one local run did and how fast it went"""
+
+    test_run: Optional[str] = None
+    cases: int = 0
+    steps: int = 0
+    messages: int = 0
+    invocations: int = 0
+    failed_invocations: int = 0
+    dead_letters: int = 0
+    duration_seconds: float = 0.0
+    peak_memory_bytes: Optional[int] = None
+    initializer_result: Optional[dict] = field(default=None, repr=False)
+    step_latencies_ms: list[float] = field(default_factory=list, repr=False)
+
+    @property
+    def cases_per_second(self) -> float:
+        return self.cases / self.duration_seconds if self.duration_seconds else 0.0
+
+    @property
+    def p50_step_latency_ms(self) -> float:
+        return percentile(self.step_latencies_ms, 50)
+
+    @property
+    def p99_step_latency_ms(self) -> float:
+        return percentile(self.step_latencies_ms, 99)
+
+
+class LocalPipeline:
+    """Runs a test suite through the initializer and processor handlers in-process.
+
+    Parameters:
+        lex: The fake Lex runtime the processor calls.
+        concurrency: Number of processor invocations running at the same time.
+        batch_size: Messages handed to each processor invocation (the event source mapping batch size).
+        max_receives: Messages whose invocation failed this many times go to the dead-letter queue instead of being redelivered.
+        environment: Extra module level settings for the lambdas, e.g. {'MESSAGE_BUDGET_SECONDS': 2.0}.
+        lanes: Bots with a queue of their own, drained by at most this many processor invocations
+            at a time on top of the others, e.g. {'BOTID': 2} (AppConfig.bot_lanes).
+    """
+
+    def __init__(
+        self,
+        lex: Optional[FakeLex] = None,
+        bucket: str = 'lex-analytics-test-tool-bucket',
+        prefix: str = 'lex-analytics',
+        concurrency: int = 1,
+        batch_size: int = 1,
+        max_receives: int = 3,
+        environment: Optional[dict] = None,
+        lanes: Optional[dict] = None,
+    ):
+        self.lex = lex or FakeLex()
+        self.s3 = FakeS3()
+        self.sqs = FakeSQS()
+        self.firehose = FakeFirehose()
+        self.lambda_ = FakeLambda()
+        self.bucket = bucket
+        self.prefix = prefix
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_receives = max_receives
+        self.environment = environment or {}
+        self.lanes = lanes or {}
+        self.initializer = None
+        self.processor = None
+        self.differ = None
+        self.redrive = None
+        self._patches = None
+
+    def __enter__(self) -> 'LocalPipeline':
+        # the lambdas create boto3 clients at import time, which only needs a region
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        from lambdas.differ import index as differ
+        from lambdas.initializer import index as initializer
+        from lambdas.processor import index as processor
+        from lambdas.redrive import index as redrive
+
+        self.initializer = initializer
+        self.processor = processor
+        self.differ = differ
+        self.redrive = redrive
+        self.lambda_.functions[PROCESSOR_FUNCTION_NAME] = processor.handler
+        self._patches = ExitStack()
+        for module, attributes in (
+            (initializer, {'s3_client': self.s3, 'sqs_client': self.sqs, 'lambda_client': self.lambda_,
+                           'QUEUE_URL': QUEUE_URL, 'PROCESSOR_FUNCTION_NAME': PROCESSOR_FUNCTION_NAME,
+                           'LANE_QUEUE_URLS': {bot_id: lane_url(bot_id) for bot_id in self.lanes},
+                           'RUNS_PREFIX': f'{self.prefix}/runs', 'WARMUP_HOLD_MS': 0}),
+            (processor, {'s3_client': self.s3, 'sqs_client': self.sqs, 'firehose_client': self.firehose, 'lex_client': self.lex,
+                         'lex_client_for': lambda region: self.lex, # every target region is served by the fake
+                         'QUEUE_URL': QUEUE_URL, 'FIREHOSE_NAME': FIREHOSE_NAME,
+                         'DLQ_URL': DLQ_URL, 'MAX_RECEIVE_COUNT': self.max_receives,
+                         'RESULTS_BUCKET': self.bucket, 'CASSETTE_PREFIX': f'{self.prefix}/cassettes',
+                         'INDEX_PREFIX': f'{self.prefix}/index'}),
+            (differ, {'s3_client': self.s3, 'RESULTS_BUCKET': self.bucket, 'INDEX_PREFIX': f'{self.prefix}/index'}),
+            (redrive, {'sqs_client': self.sqs, 'QUEUE_URL': QUEUE_URL, 'DLQ_URL': DLQ_URL}),
+        ):
+            for name, value in {**attributes, **self.environment}.items():
+                if hasattr(module, name):
+                    self._patches.enter_context(patch.object(module, name, value))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._patches.close()
+        self._patches = None
+
+    def upload(self, content: Union[str, bytes], name: str = 'suite.csv') -> str:
+        """Drop a suite into the input prefix and return its s3 path"""
+        key = f'{self.prefix}/input/{name}'
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=content)
+        return f's3://{self.bucket}/{key}'
+
+    def run(self, content: Union[str, bytes], name: str = 'suite.csv', trace_memory: bool = False, **options) -> RunStats:
+        """Upload a suite, invoke the initializer and drain the queue through the processor.
+        options are passed on in the initializer event, e.g. lex_mode='replay', replay_run='...'
+        """
+        if self._patches is None:
+            raise RuntimeError('LocalPipeline must be used as a context manager')
+
+        stats = RunStats()
+        first_record = len(self.firehose.records)
+        first_dead_letter = self.sqs.depth(DLQ_URL)
+        s3_path = self.upload(content, name)
+
+        if trace_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        try:
+            if options.get('orchestration') == 'stepfunctions':
+                # started by the state machine, which wraps its input
+                stats.initializer_result = self.initializer.handler({'orchestration': 'stepfunctions', 'run': {'s3_path': s3_path, **options}}, None)
+                if 'batches_key' in stats.initializer_result:
+                    self.map(stats)
+            else:
+                stats.initializer_result = self.initializer.handler({'s3_path': s3_path, **options}, None)
+                stats.messages = sum(self.sqs.depth(queue_url) for queue_url in [QUEUE_URL, *map(lane_url, self.lanes)])
+                self.drain(stats)
+        finally:
+            stats.duration_seconds = time.perf_counter() - start_time
+            stats.dead_letters = self.sqs.depth(DLQ_URL) - first_dead_letter
+            if trace_memory:
+                stats.peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        cases = set()
+        for data in self.firehose.records[first_record:]:
+            step = json.loads(data)
+            cases.add(step['test_case'])
+            stats.test_run = step['test_run']
+            if 'lex_latency_ms' in step:
+                stats.step_latencies_ms.append(step['lex_latency_ms'])
+        stats.cases = len(cases)
+        stats.steps = len(self.firehose.records) - first_record
+        return stats
+
+    def drain(self, stats: RunStats):
+        """Invoke the processor until the queues are empty, like the event source mappings would:
+        concurrency workers for the test queue and each lane's cap for its queue.
+        Each worker polls for its next batch as soon as its previous invocation returns.
+        """
+        lock = threading.Lock()
+
+        def poll(queue_url: str):
+            while True:
+                records = self.sqs.receive(queue_url, self.batch_size)
+                if not records:
+                    # another worker may still hand its batch back to the queue
+                    if not self.sqs.in_flight:
+                        return
+                    time.sleep(0.001)
+                    continue
+
+                error = self._invoke(records)
+                with lock:
+                    stats.invocations += 1
+                    if error is not None:
+                        stats.failed_invocations += 1
+                for record in records:
+                    if error is None:
+                        # a successful invocation deletes the batch
+                        self.sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=record['receiptHandle'])
+                        continue
+                    # a failed invocation returns the rest of the batch to the queue (the processor
+                    # already deleted what it processed), the redrive policy catches what keeps failing
+                    self.sqs.release(record['receiptHandle'], self.max_receives, DLQ_URL)
+
+        workers = [QUEUE_URL] * self.concurrency + [lane_url(bot_id) for bot_id, cap in self.lanes.items() for _ in range(cap)]
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            for future in [executor.submit(poll, queue_url) for queue_url in workers]:
+                future.result()
+
+    def map(self, stats: RunStats):
+        """Invoke the processor over the batches the initializer wrote, like the state machine's Distributed Map would"""
+        result = stats.initializer_result
+        body = self.s3.get_object(Bucket=result['batches_bucket'], Key=result['batches_key'])['Body'].read()
+        items = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        stats.messages = len(items)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            errors = list(executor.map(self._invoke, [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]))
+        stats.invocations = len(errors)
+        stats.failed_invocations = sum(error is not None for error in errors)
+
+    def _invoke(self, records: list[dict]) -> Optional[Exception]:
+        try:
+            self.processor.handler({'Records': records}, None)
+        except Exception as e:
+            return e
+        return None
@@ -6,7 +6,7 @@ Contains environment specific configurations based on deployment stage.
 #    Pros: App config looks much cleaner
 #    Cons: Not all reources will have same ids. Example: if we depend on cognito user pool, that will be different for each region. Alterantively, we look up the pool from parameter store.
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from infastructure.util.get_project_meta import get_project_meta
 
@@ -24,6 +24,63 @@ class AppConfig:
 
     prefix: str = meta.name
 
+    # Processor sizing. The initializer packs test cases into SQS messages that should each
+    # finish within message_budget_seconds, estimated at step_latency_seconds per Lex call.
+    # A conversation longer than the budget gets a message of its own, so the timeout leaves room
+    # for those; cases estimated above it are not queued (the initializer reports them).
+    processor_timeout_seconds: int = 120
+    message_budget_seconds: float = 8.0
+    step_latency_seconds: float = 1.0
+    # optional key in the results bucket of per bot latencies measured in earlier runs, used instead
+    # of step_latency_seconds for the bots it lists (see the README for how to create it)
+    latency_stats_key: str = ''
+
+    # live, record (store every Lex exchange in the results bucket) or replay (serve stored exchanges).
+    # Runs started with replay (here or with lex_mode) have to name the replay_run to replay
+    lex_mode: str = 'live'
+
+    # end every conversation at its first failing step unless a run says otherwise
+    fail_fast: bool = False
+
+    # a step whose Lex latency grew by more than this between two runs is reported as a regression
+    latency_regression_threshold_ms: int = 500
+
+    # the initializer parses the suite, runs smoke tests and queues everything up in one invocation.
+    # Sorted suites stream through in flat memory, unsorted ones are held in full (see the README
+    # for the sizes this supports). Parquet suites are spooled to /tmp, which has to fit them
+    initializer_timeout_seconds: int = 300
+    initializer_memory_mib: int = 1024
+    initializer_ephemeral_storage_mib: int = 2048
+
+    # Fleet-wide per bot caps: each bot listed here gets a queue of its own (a lane), drained by at
+    # most this many processors at a time, e.g. {'BOTID': 5}. The minimum is 2. Other bots share the
+    # test queue, which has no cap
+    bot_lanes: dict = field(default_factory=dict)
+
+    # Per bot caps within a single processor invocation: conversations run side by side for one bot
+    # and Lex calls per second to it (0 for no limit), overridden for specific bots by
+    # invocation_bot_limits, e.g. {'BOTID': {'concurrency': 4, 'rate': 10}}. Concurrent invocations
+    # each apply them, so a bot sees them multiplied by the processors working on it (see bot_lanes)
+    invocation_bot_concurrency: int = 1
+    invocation_bot_rate_limit: float = 0.0
+    invocation_bot_limits: dict = field(default_factory=dict)
+
+    # a test message that failed this many receives goes to the dead-letter queue, from where
+    # the redrive lambda sends it back at redrive_messages_per_second once the cause is fixed
+    max_receive_count: int = 3
+    redrive_messages_per_second: float = 5.0
+
+    # What the S3 drop starts: 'sqs' (initializer queues the run) or 'stepfunctions' (a state machine
+    # whose Distributed Map runs the processor over the packed messages). Both are always deployed.
+    orchestration: str = 'sqs'
+    map_max_concurrency: int = 50
+    map_tolerated_failure_percentage: float = 5.0
+    map_items_per_batch: int = 1 # packed messages per processor invocation
+
+    # As a run is queued, the initializer starts as many processor containers as the cases queued so
+    # far need to reach this many test cases per second (0 to not pre-warm), up to prewarm_max_concurrency
+    prewarm_cases_per_second: float = 0.0
+    prewarm_max_concurrency: int = 100
 
 
 # Configuration mapping
@@ -1,5 +1,8 @@
+import json
+
 from aws_cdk import (
     Duration,
+    Size,
     Stack,
     aws_sqs as sqs,
     aws_s3 as s3,
@@ -9,6 +12,8 @@ from aws_cdk import (
     aws_events as events,
     aws_events_targets as targets,
     aws_glue as glue,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as tasks,
     Aws as cdk_aws,
     aws_logs as logs,
 )
@@ -32,18 +37,51 @@ class LexTestTool(Stack):
             assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
         )
 
+        # Messages that keep failing are set aside instead of being retried forever
+        dead_letter_queue = sqs.Queue(self, "TestDeadLetterQueue", queue_name=f"{props.prefix}-test-dlq", retention_period=Duration.days(14))
+
         # Define the SQS queue
-        test_queue = sqs.Queue(self, "TestQueue", queue_name=f"{props.prefix}-test-queue", visibility_timeout=Duration.seconds(30),
+        # The visibility timeout has to outlast the processor, or messages are redelivered while still
+        # being worked on. AWS recommends six times the function timeout for SQS event sources
+        test_queue = sqs.Queue(self, "TestQueue", queue_name=f"{props.prefix}-test-queue",
+            visibility_timeout=Duration.seconds(6 * props.processor_timeout_seconds),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=props.max_receive_count, queue=dead_letter_queue),
         )
 
+        # A lane per capped bot: its test cases are queued on a queue of their own, drained by at most
+        # bot_lanes[bot_id] processors at a time across the fleet
+        lane_queues = {
+            bot_id: sqs.Queue(self, f"LaneQueue{bot_id}", queue_name=f"{props.prefix}-test-queue-{bot_id.lower()}",
+                visibility_timeout=Duration.seconds(6 * props.processor_timeout_seconds),
+                dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=props.max_receive_count, queue=dead_letter_queue),
+            )
+            for bot_id in props.bot_lanes
+        }
+
         initializer = create_lambda(
             self,
             'initializer',
             lambda_role,
             function_name=f"{props.prefix}-initializer",
             description="Read test cases from S3 and queues them up in SQS. Triggered by S3 file drop.",
+            # bundled with its requirement.txt, for zstd and Parquet suites
+            inline=False,
+            timeout=Duration.seconds(props.initializer_timeout_seconds),
+            memory_size=props.initializer_memory_mib,
+            ephemeral_storage_size=Size.mebibytes(props.initializer_ephemeral_storage_mib),
             environment={
                 "QUEUE_URL": test_queue.queue_url,
+                "LANE_QUEUE_URLS": self.to_json_string({bot_id: queue.queue_url for bot_id, queue in lane_queues.items()}),
+                "PROCESSOR_FUNCTION_NAME": f"{props.prefix}-processor",
+                "RUNS_PREFIX": f"{props.prefix}/runs",
+                "MESSAGE_BUDGET_SECONDS": str(props.message_budget_seconds),
+                "PROCESSOR_TIMEOUT_SECONDS": str(props.processor_timeout_seconds),
+                "INITIALIZER_TIMEOUT_SECONDS": str(props.initializer_timeout_seconds),
+                "LEX_MODE": props.lex_mode,
+                "STEP_LATENCY_SECONDS": str(props.step_latency_seconds),
+                **({"LATENCY_STATS_KEY": props.latency_stats_key} if props.latency_stats_key else {}),
+                "PREWARM_CASES_PER_SECOND": str(props.prewarm_cases_per_second),
+                "PREWARM_MAX_CONCURRENCY": str(props.prewarm_max_concurrency),
             },
         )
 
@@ -60,6 +98,15 @@ class LexTestTool(Stack):
             versioned=True,
         )
 
+        # The initializer reads test cases (and latency stats) from the bucket and queues them up,
+        # the processor records and replays Lex cassettes in it
+        results_bucket.grant_read_write(lambda_role)
+        test_queue.grant_send_messages(lambda_role)
+        for queue in lane_queues.values():
+            queue.grant_send_messages(lambda_role)
+        # The processor dead-letters messages with their failure reason, the redrive lambda moves them back
+        dead_letter_queue.grant_send_messages(lambda_role)
+        dead_letter_queue.grant_consume_messages(lambda_role)
 
         event_rule = events.Rule(
             self,
@@ -79,7 +126,8 @@ class LexTestTool(Stack):
             ),
         )
 
-        event_rule.add_target(targets.LambdaFunction(initializer))
+        if props.orchestration == 'sqs':
+            event_rule.add_target(targets.LambdaFunction(initializer))
 
         # Create a log group for firehose
         log_group = logs.LogGroup(
@@ -146,7 +194,7 @@ class LexTestTool(Stack):
                     "sqs:GetQueueAttributes",
                     "sqs:ChangeMessageVisibility"
                 ],
-                resources=[test_queue.queue_arn]
+                resources=[test_queue.queue_arn, *(queue.queue_arn for queue in lane_queues.values())]
             )
         )
 
@@ -162,26 +210,152 @@ class LexTestTool(Stack):
             )
         )
 
+        # Add permissions for Lex (the processor calls the bots under test, a run's targets can be in other regions)
+        lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["lex:RecognizeText"],
+                resources=[f"arn:aws:lex:*:{cdk_aws.ACCOUNT_ID}:bot-alias/*"]
+            )
+        )
+
+        # The initializer compares bot versions to select test cases for changed intents
+        lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["lex:ListIntents", "lex:DescribeIntent"],
+                resources=[f"arn:aws:lex:{cdk_aws.REGION}:{cdk_aws.ACCOUNT_ID}:bot/*"]
+            )
+        )
+
+        # The initializer runs smoke tests by invoking the processor directly
+        lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["lambda:InvokeFunction"],
+                resources=[f"arn:aws:lambda:{cdk_aws.REGION}:{cdk_aws.ACCOUNT_ID}:function:{props.prefix}-processor"]
+            )
+        )
+
         processor = create_lambda(
             self,
             'processor',
             lambda_role,
             function_name=f"{props.prefix}-processor",
-            timeout=Duration.seconds(10),
+            timeout=Duration.seconds(props.processor_timeout_seconds),
             description="Process test cases from SQS and send results to Firehose.",
             environment={
                 "FIREHOSE_NAME": results_firehose.delivery_stream_name,
+                "QUEUE_URL": test_queue.queue_url,
+                "DLQ_URL": dead_letter_queue.queue_url,
+                "MAX_RECEIVE_COUNT": str(props.max_receive_count),
+                "RESULTS_BUCKET": results_bucket.bucket_name,
+                "CASSETTE_PREFIX": f"{props.prefix}/cassettes",
+                "LEX_MODE": props.lex_mode,
+                "FAIL_FAST": str(props.fail_fast).lower(),
+                "INDEX_PREFIX": f"{props.prefix}/index",
+                "INVOCATION_BOT_CONCURRENCY": str(props.invocation_bot_concurrency),
+                "INVOCATION_BOT_RATE_LIMIT": str(props.invocation_bot_rate_limit),
+                "INVOCATION_BOT_LIMITS": json.dumps(props.invocation_bot_limits),
+            },
+        )
+
+        # Compares two runs using the per-run indexes the processor writes
+        create_lambda(
+            self,
+            'differ',
+            lambda_role,
+            function_name=f"{props.prefix}-differ",
+            timeout=Duration.seconds(60),
+            description="Compare two test runs: new failures, fixes, intent drift and latency regressions.",
+            environment={
+                "RESULTS_BUCKET": results_bucket.bucket_name,
+                "INDEX_PREFIX": f"{props.prefix}/index",
+                "LATENCY_THRESHOLD_MS": str(props.latency_regression_threshold_ms),
+            },
+        )
+
+        # Sends dead-lettered test messages back to the test queue at a controlled rate
+        create_lambda(
+            self,
+            'redrive',
+            lambda_role,
+            function_name=f"{props.prefix}-redrive",
+            timeout=Duration.minutes(15),
+            description="Move dead-lettered test messages back to the test queue at a controlled rate.",
+            environment={
+                "QUEUE_URL": test_queue.queue_url,
+                "DLQ_URL": dead_letter_queue.queue_url,
+                "REDRIVE_RATE": str(props.redrive_messages_per_second),
             },
         )
 
+        # Step Functions orchestration: the initializer packs the run into S3 instead of the queue, and a
+        # Distributed Map runs the processor over it with capped concurrency, retries and failure tolerance
+        initialize = tasks.LambdaInvoke(
+            self,
+            "Initialize",
+            lambda_function=initializer,
+            payload=sfn.TaskInput.from_object({"orchestration": "stepfunctions", "run": sfn.JsonPath.entire_payload}),
+            payload_response_only=True,
+        )
+
+        process = tasks.LambdaInvoke(
+            self,
+            "Process",
+            lambda_function=processor,
+            payload=sfn.TaskInput.from_object({"Records": sfn.JsonPath.list_at("$.Items"), "summary": True}),
+            payload_response_only=True,
+        )
+        process.add_retry(errors=["States.TaskFailed"], interval=Duration.seconds(5), max_attempts=2, backoff_rate=2)
+
+        run_test_cases = sfn.DistributedMap(
+            self,
+            "RunTestCases",
+            item_reader=sfn.S3JsonLItemReader(bucket_name_path=sfn.JsonPath.string_at("$.batches_bucket"), key=sfn.JsonPath.string_at("$.batches_key")),
+            item_batcher=sfn.ItemBatcher(max_items_per_batch=props.map_items_per_batch),
+            # rendered with the @aws-cdk/aws-stepfunctions:useDistributedMapResultWriterV2 flag in cdk.json
+            result_writer_v2=sfn.ResultWriterV2(bucket=results_bucket, prefix=f"{props.prefix}/orchestration"),
+            map_execution_type=sfn.StateMachineType.EXPRESS,
+            max_concurrency=props.map_max_concurrency,
+            tolerated_failure_percentage=props.map_tolerated_failure_percentage,
+        )
+        run_test_cases.item_processor(process)
+
+        state_machine = sfn.StateMachine(
+            self,
+            "TestRunStateMachine",
+            state_machine_name=f"{props.prefix}-test-run",
+            definition_body=sfn.DefinitionBody.from_chainable(
+                initialize.next(
+                    # duplicate runs and runs stopped by their smoke tests have nothing to process
+                    sfn.Choice(self, "HasTestCases")
+                    .when(sfn.Condition.is_present("$.batches_key"), run_test_cases)
+                    .otherwise(sfn.Succeed(self, "NothingToProcess"))
+                )
+            ),
+        )
+        results_bucket.grant_read_write(state_machine)
+
+        if props.orchestration == 'stepfunctions':
+            event_rule.add_target(targets.SfnStateMachine(state_machine))
+
         # Manually create the event source mapping
         lambda_.CfnEventSourceMapping(
             self,
             "ProcessorEventSourceMapping",
             function_name=processor.function_name,
             event_source_arn=test_queue.queue_arn,
-            batch_size=10
+            # Each message is already packed to fit the time budget, so hand them over one at a time
+            batch_size=1
         )
+        for bot_id, queue in lane_queues.items():
+            lambda_.CfnEventSourceMapping(
+                self,
+                f"LaneEventSourceMapping{bot_id}",
+                function_name=processor.function_name,
+                event_source_arn=queue.queue_arn,
+                batch_size=1,
+                # SQS event sources can't be capped below 2 concurrent invocations
+                scaling_config=lambda_.CfnEventSourceMapping.ScalingConfigProperty(maximum_concurrency=max(2, props.bot_lanes[bot_id])),
+            )
 
         # Create a glue database
         glue_database = glue.CfnDatabase(
@@ -221,6 +395,9 @@ class LexTestTool(Stack):
                         {'name': 'actual_state', 'type': 'string'},
                         {'name': 'test_result', 'type': 'string'},
                         {'name': 'test_explanation', 'type': 'string'},
+                        {'name': 'lex_latency_ms', 'type': 'int'},
+                        {'name': 'target', 'type': 'string'},
+                        {'name': 'region', 'type': 'string'},
                     ],
                     'location': f"s3://{results_bucket.bucket_name}/{props.prefix}/results",
                     'input_format': 'org.apache.hadoop.mapred.TextInputFormat',
@@ -1,13 +1,47 @@
 import os
+import shutil
+import subprocess
+import sys
 from typing import Optional, Mapping
 
+import jsii
+
 from aws_cdk.aws_logs import RetentionDays
 from aws_cdk.aws_iam import Role
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk.aws_logs import LogGroup
-from aws_cdk import RemovalPolicy, Duration
+from aws_cdk import BundlingOptions, ILocalBundling, RemovalPolicy, Duration, Size
 from constructs import Construct
 
+RUNTIME = _lambda.Runtime.PYTHON_3_9
+ARCHITECTURE = _lambda.Architecture.ARM_64
+
+
+@jsii.implements(ILocalBundling)
+class PipInstall:
+    """Bundle a lambda directory with the wheels of its requirement.txt without Docker.
+    pip downloads wheels for the lambda's runtime and architecture, so this works from any machine
+    that has pip; when it fails, CDK falls back to bundling in the runtime's Docker image.
+    """
+
+    def __init__(self, source_dir: str):
+        self.source_dir = source_dir
+
+    def try_bundle(self, output_dir, options) -> bool:
+        requirements = os.path.join(self.source_dir, 'requirement.txt')
+        try:
+            if os.path.getsize(requirements):
+                subprocess.run([
+                    sys.executable, '-m', 'pip', 'install', '--quiet', '-r', requirements, '--target', output_dir,
+                    '--platform', 'manylinux2014_aarch64', '--implementation', 'cp', '--python-version', '3.9',
+                    '--only-binary=:all:',
+                ], check=True)
+            shutil.copytree(self.source_dir, output_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns('__pycache__'))
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f'Local bundling of {self.source_dir} failed, bundling with Docker: {e}', file=sys.stderr)
+            return False
+        return True
+
 
 def create_lambda(
     self: Construct,
@@ -18,12 +52,15 @@ def create_lambda(
     environment: Optional[Mapping[str, str]],
     timeout: Optional[Duration] = None,
     inline: bool = True,
+    memory_size: Optional[int] = None,
+    ephemeral_storage_size: Optional[Size] = None,
 ) -> _lambda.Function:
     """
     Create a Lambda function and log group with default settings
 
     Parameters:
         inline: Makes it easier to dploy single-file lambdas without staging assest in S3 first.
+            Lambdas with dependencies (in their requirement.txt) are deployed as an asset instead, bundled with them.
 
     Returns:
         _lambda.Function: The created Lambda function
@@ -44,14 +81,23 @@ def create_lambda(
     script_dir = os.path.dirname(os.path.abspath(__file__))
     # Go up two directory levels to get to the project root (lex-analytics)
     project_root = os.path.dirname(os.path.dirname(script_dir))
-    lambda_path = os.path.join(project_root, 'lambdas', id, 'index.py')
+    lambda_path = os.path.join(project_root, 'lambdas', id)
 
     if inline:
-        index_file_path = os.path.join(project_root, 'lambdas', id, 'index.py')
+        index_file_path = os.path.join(lambda_path, 'index.py')
         with open(index_file_path, 'r', encoding='utf-8') as file:
             code = _lambda.Code.from_inline(file.read())
     else:
-        code = _lambda.Code.from_asset(lambda_path)
+        code = _lambda.Code.from_asset(
+            lambda_path,
+            exclude=['__pycache__'],
+            bundling=BundlingOptions(
+                image=RUNTIME.bundling_image,
+                platform='linux/arm64',
+                command=['bash', '-c', 'pip install --no-cache-dir -r requirement.txt -t /asset-output && cp -au . /asset-output'],
+                local=PipInstall(lambda_path),
+            ),
+        )
 
     fn = _lambda.Function(
         self,
@@ -59,11 +105,13 @@ def create_lambda(
         role=role,
         function_name=function_name,
         description=description,
-        runtime=_lambda.Runtime.PYTHON_3_9,
-        architecture=_lambda.Architecture.ARM_64,
+        runtime=RUNTIME,
+        architecture=ARCHITECTURE,
         handler='index.handler',
         environment=environment,
         timeout=timeout,
+        memory_size=memory_size,
+        ephemeral_storage_size=ephemeral_storage_size,
         code=code,
     )
 
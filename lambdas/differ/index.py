@@ -0,0 +1,150 @@
+# differ.py
+"""
+This lambda function compares two test runs using the compact per-run index the processor writes,
+so tonight's run can be checked against last night's without scanning the raw results.
+It reports new failures, fixes, intent drift and steps whose Lex latency regressed.
+
+It can also be run locally with AWS credentials:
+    python -m lambdas.differ.index <base_run> <run> --bucket <results bucket> --index-prefix <prefix>/index
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import boto3
+
+# Configure logging
+logging.basicConfig(level=os.environ.get('LOGGING_LEVEL', 'DEBUG'))
+logger = logging.getLogger(__name__) # __name__ is the name of the module
+
+# Initialize AWS clients
+s3_client = boto3.client('s3')
+
+# Environment variables
+RESULTS_BUCKET = os.getenv('RESULTS_BUCKET')
+INDEX_PREFIX = os.getenv('INDEX_PREFIX', 'index')
+LATENCY_THRESHOLD_MS = int(os.getenv('LATENCY_THRESHOLD_MS', '500'))
+
+# positions in an index entry: [result hash, actual_intent, test_result, failed, lex_latency_ms]
+HASH, INTENT, RESULT, FAILED, LATENCY = range(5)
+
+
+def list_parts(test_run: str) -> list[str]:
+    """Keys of the index parts the processor wrote for a run"""
+    keys, kwargs = [], {}
+    while True:
+        response = s3_client.list_objects_v2(Bucket=RESULTS_BUCKET, Prefix=f'{INDEX_PREFIX}/{test_run}/parts/', **kwargs)
+        keys.extend(obj['Key'] for obj in response.get('Contents', []))
+        if not response.get('IsTruncated'):
+            return keys
+        kwargs = {'ContinuationToken': response['NextContinuationToken']}
+
+
+def read_json_gz(key: str):
+    response = s3_client.get_object(Bucket=RESULTS_BUCKET, Key=key)
+    return json.loads(gzip.decompress(response['Body'].read()))
+
+
+def load_index(test_run: str) -> dict[str, dict[str, list]]:
+    """Load the index of a run as {test_case: {step: entry}}.
+
+    The parts are merged into a single index object the first time, later loads read that
+    object instead, unless more parts have been written since (the run was still going).
+    """
+    parts = list_parts(test_run)
+    merged_key = f'{INDEX_PREFIX}/{test_run}/index.json.gz'
+    try:
+        merged = read_json_gz(merged_key)
+        if merged['parts'] == len(parts):
+            return merged['entries']
+    except Exception as e:
+        logger.debug('No merged index for run %s: %s', test_run, e)
+
+    if not parts:
+        raise ValueError(f'No index for run {test_run}')
+
+    entries = {}
+    for key in parts:
+        for test_case, steps in read_json_gz(key).items():
+            entries.setdefault(test_case, {}).update(steps)
+
+    body = gzip.compress(json.dumps({'parts': len(parts), 'entries': entries}).encode('utf-8'))
+    s3_client.put_object(Bucket=RESULTS_BUCKET, Key=merged_key, Body=body)
+    logger.info('Merged %d index parts for run %s', len(parts), test_run)
+    return entries
+
+
+def diff_indexes(base: dict, run: dict, latency_threshold_ms: int = None) -> dict:
+    """Compare two run indexes in one pass over their steps.
+
+    Returns:
+    dict: new_failures, fixes, intent_drift and latency_regressions (lists of steps), the steps
+        only in one of the runs, and a summary with the count of each
+    """
+    latency_threshold_ms = LATENCY_THRESHOLD_MS if latency_threshold_ms is None else latency_threshold_ms
+    report = {'new_failures': [], 'fixes': [], 'intent_drift': [], 'latency_regressions': [], 'added': [], 'removed': []}
+
+    for test_case, steps in run.items():
+        base_steps = base.get(test_case, {})
+        for step, entry in steps.items():
+            key = {'test_case': test_case, 'step': step}
+            before = base_steps.get(step)
+            if before is None:
+                report['added'].append(key)
+                continue
+            if entry[HASH] == before[HASH] and entry[LATENCY] == before[LATENCY]:
+                continue
+
+            if entry[FAILED] and not before[FAILED]:
+                report['new_failures'].append({**key, 'test_result': entry[RESULT], 'base_test_result': before[RESULT]})
+            elif before[FAILED] and not entry[FAILED]:
+                report['fixes'].append({**key, 'test_result': entry[RESULT], 'base_test_result': before[RESULT]})
+            if entry[INTENT] != before[INTENT]:
+                report['intent_drift'].append({**key, 'actual_intent': entry[INTENT], 'base_actual_intent': before[INTENT]})
+            if entry[LATENCY] is not None and before[LATENCY] is not None and entry[LATENCY] - before[LATENCY] > latency_threshold_ms:
+                report['latency_regressions'].append({**key, 'lex_latency_ms': entry[LATENCY], 'base_lex_latency_ms': before[LATENCY]})
+
+    for test_case, steps in base.items():
+        run_steps = run.get(test_case, {})
+        report['removed'].extend({'test_case': test_case, 'step': step} for step in steps if step not in run_steps)
+
+    report['summary'] = {name: len(items) for name, items in report.items()}
+    return report
+
+
+def handler(event, context):
+    """
+    Expects event with the following keys:
+    'base_run': The test_run to compare against, e.g. last night's run
+    'run': The test_run to check
+    Optional keys:
+    'latency_threshold_ms': Latency increase above which a step counts as regressed. Default LATENCY_THRESHOLD_MS
+    """
+
+    logger.debug('Event Received: %s', event)
+
+    report = diff_indexes(load_index(event['base_run']), load_index(event['run']), event.get('latency_threshold_ms'))
+    logger.info('Run %s compared to %s: %s', event['run'], event['base_run'], report['summary'])
+
+    return {
+        'statusCode': 200,
+        'base_run': event['base_run'],
+        'run': event['run'],
+        **report,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two Lex test runs')
+    parser.add_argument('base_run', help='test_run to compare against')
+    parser.add_argument('run', help='test_run to check')
+    parser.add_argument('--bucket', default=RESULTS_BUCKET, help='results bucket')
+    parser.add_argument('--index-prefix', default=INDEX_PREFIX, help='prefix of the run indexes in the bucket')
+    parser.add_argument('--latency-threshold-ms', type=int, default=LATENCY_THRESHOLD_MS)
+    args = parser.parse_args()
+
+    RESULTS_BUCKET, INDEX_PREFIX = args.bucket, args.index_prefix
+    result = handler({'base_run': args.base_run, 'run': args.run, 'latency_threshold_ms': args.latency_threshold_ms}, None)
+    print(json.dumps(result, indent=2))
@@ -1,16 +1,47 @@
 # initializer.py
 """
 This lambda function is responsible for initializing the Lex Analytics pipeline.
-It takes an S3 path to a CSV file as input and groups the records by test_case.
+It takes an S3 path to a test suite as input and groups the records by test_case.
+Suites are CSV, JSON Lines or Parquet, optionally gzip or zstd compressed, and decoded as a stream.
+A manifest (*.manifest.json) lists several suite files to run together.
+Test cases are then packed into SQS messages that each fit a processor time budget.
+Template test cases (with {placeholder} values) are expanded lazily and streamed into the queue.
+A run can be narrowed to the intents that changed, and gated on a smoke subset run first.
+Runs are idempotent: a duplicate event for the same object version is ignored, a retry of a run
+that stopped partway resumes it after the messages it recorded as sent, and a delta rerun only
+queues the test cases that changed since the previous tracked run of the same suite.
+A run can name a matrix of targets (bot/alias/locale/region); the suite is parsed once and every
+test case is queued once per target.
+As a run is queued, the processor can be pre-warmed with as many containers as the run needs
+to reach a throughput target from its start.
+When started by the state machine (Step Functions orchestration), the packed messages are written
+to S3 as JSON Lines for its Distributed Map to read, instead of being sent to the queue.
 """
 
 import logging
 import os
 import boto3
+from botocore.config import Config
+import codecs
 import csv
+import io
 import json
-from collections import defaultdict
+from collections import Counter, defaultdict
 import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import math
+import operator
+import random
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
 
 # Configure logging
 logging.basicConfig(level=os.environ.get('LOGGING_LEVEL', 'DEBUG'))
@@ -19,20 +50,788 @@ logger = logging.getLogger(__name__) # __name__ is the name of the module
 # Initialize AWS clients
 s3_client = boto3.client('s3')
 sqs_client = boto3.client('sqs')
+# smoke tests wait for the processor, which can run up to its timeout
+lambda_client = boto3.client('lambda', config=Config(read_timeout=int(os.getenv('PROCESSOR_TIMEOUT_SECONDS', '120')) + 10))
+lex_models_client = boto3.client('lexv2-models')
 
 # Environment variables
 QUEUE_URL = os.getenv('QUEUE_URL')
+# bots capped across the processor fleet have a queue of their own (a lane), e.g. {"BOTID": "https://sqs..."}
+LANE_QUEUE_URLS = json.loads(os.getenv('LANE_QUEUE_URLS') or '{}')
+MESSAGE_BUDGET_SECONDS = float(os.getenv('MESSAGE_BUDGET_SECONDS', '8')) # target processing time per SQS message
+STEP_LATENCY_SECONDS = float(os.getenv('STEP_LATENCY_SECONDS', '1.0')) # default estimate for one Lex call
+LATENCY_STATS_KEY = os.getenv('LATENCY_STATS_KEY') # optional S3 key with historical per-step latency by bot_id
+PACK_WINDOW = int(os.getenv('PACK_WINDOW', '1000')) # test cases packed together before their messages are sent
+PROCESSOR_FUNCTION_NAME = os.getenv('PROCESSOR_FUNCTION_NAME') # invoked directly to run smoke tests
+INITIALIZER_TIMEOUT_SECONDS = float(os.getenv('INITIALIZER_TIMEOUT_SECONDS', '300')) # an invocation still running past this is gone
+PROCESSOR_TIMEOUT_SECONDS = float(os.getenv('PROCESSOR_TIMEOUT_SECONDS', '120')) # test cases estimated longer than this are not queued
+SMOKE_CONCURRENCY = int(os.getenv('SMOKE_CONCURRENCY', '10'))
+LEX_MODE = os.getenv('LEX_MODE', 'live') # the processor's default, a run can override it with lex_mode
+RUNS_PREFIX = os.getenv('RUNS_PREFIX', 'runs') # run markers and per-suite test case hashes
+PREWARM_CASES_PER_SECOND = float(os.getenv('PREWARM_CASES_PER_SECOND', '0')) # throughput target to pre-warm for, 0 to not pre-warm
+PREWARM_MAX_CONCURRENCY = int(os.getenv('PREWARM_MAX_CONCURRENCY', '100'))
+WARMUP_HOLD_MS = int(os.getenv('WARMUP_HOLD_MS', '1000')) # how long each warm-up invocation keeps its container busy
+
+MAX_MESSAGE_BYTES = 250 * 1024 # SQS limit is 256 KiB, leave some headroom
+MAX_BATCH_MESSAGES = 10 # SendMessageBatch takes at most 10 messages, 256 KiB in total
+MAX_BATCH_BYTES = 256 * 1024
+CHECKPOINT_MESSAGES = 500 # messages sent between two records of a run's progress, at most this many are sent twice when it resumes
+BATCHES_PART_BYTES = 8 * 1024 * 1024 # multipart upload parts of the state machine's batches, S3 needs at least 5 MiB
+
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+NUMBERS = re.compile(r'(\d+)')
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+# event options copied onto every row for the processor
+RUN_OPTIONS = ('lex_mode', 'replay_run', 'fail_fast')
+# fields the initializer adds to every row, they are not part of a test case's content
+RUN_FIELDS = ('test_run', 's3_path', 'target') + RUN_OPTIONS
+# fields of a row a target can override
+TARGET_FIELDS = ('bot_id', 'alias_id', 'locale_id', 'region')
+
+
+def load_step_latencies(bucket: str) -> dict:
+    """Load historical per-step Lex latency (seconds) keyed by bot_id.
+
+    The stats object is a JSON document such as {"default": 0.8, "bots": {"BOTID": 1.2}}.
+    Returns an empty dict when no stats are configured or they cannot be read.
+    """
+    if not LATENCY_STATS_KEY:
+        return {}
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=LATENCY_STATS_KEY)
+        stats = json.loads(response['Body'].read().decode('utf-8'))
+    except Exception as e:
+        logger.warning('Could not load latency stats from s3://%s/%s: %s', bucket, LATENCY_STATS_KEY, e)
+        return {}
+
+    latencies = {bot_id: float(seconds) for bot_id, seconds in stats.get('bots', {}).items()}
+    if 'default' in stats:
+        latencies['default'] = float(stats['default'])
+    return latencies
+
+
+def estimate_test_case_seconds(test_case: list[dict], latencies: dict) -> float:
+    """Estimate how long the processor will take for a test_case: one Lex call per step"""
+    default = latencies.get('default', STEP_LATENCY_SECONDS)
+    return sum(latencies.get(step.get('bot_id'), default) for step in test_case)
+
+
+def pack_test_cases(test_cases: Iterable[list[dict]], latencies: dict, budget: float = None) -> list[tuple[float, list[list[dict]]]]:
+    """Pack test cases into messages that each fit the time budget.
+
+    Longest cases are placed first, each into the least loaded message that still has room,
+    so messages end up with similar run times. A test case is never split since its steps
+    share a Lex session; a case longer than the budget gets its own message.
+
+    Returns:
+    list[tuple[float, list[list[dict]]]]: (estimated seconds, test cases) per message, longest first
+    """
+    budget = MESSAGE_BUDGET_SECONDS if budget is None else budget
+
+    costed = []
+    for test_case in test_cases:
+        costed.append((estimate_test_case_seconds(test_case, latencies), len(json.dumps(test_case)), test_case))
+    costed.sort(key=lambda item: item[0], reverse=True)
+
+    # cases that fill the budget on their own get their own message
+    messages = [[cost, size, [test_case]] for cost, size, test_case in costed if cost >= budget] # [estimated seconds, size in bytes, test cases]
+    costed = [item for item in costed if item[0] < budget]
+
+    # start with as many messages as the remaining work needs, then hand each case to the least
+    # loaded one (longest first) so they end up with similar run times
+    first = len(messages)
+    messages.extend([0.0, 0, []] for _ in range(math.ceil(sum(item[0] for item in costed) / budget)))
+    open_messages = [(0.0, index) for index in range(first, len(messages))] # min-heap of (estimated seconds, index into messages)
+    for cost, size, test_case in costed:
+        if open_messages:
+            load, index = open_messages[0]
+            message = messages[index]
+            # cases arrive longest first, so if the least loaded message can't fit this one, none can
+            if load + cost <= budget and message[1] + size <= MAX_MESSAGE_BYTES:
+                message[0] += cost
+                message[1] += size
+                message[2].append(test_case)
+                heapq.heapreplace(open_messages, (message[0], index))
+                continue
+
+        messages.append([cost, size, [test_case]])
+        heapq.heappush(open_messages, (cost, len(messages) - 1))
+
+    messages = [message for message in messages if message[2]]
+    messages.sort(key=lambda message: message[0], reverse=True)
+    return [(load, test_cases) for load, _, test_cases in messages]
+
+
+def within_timeout(test_cases: Iterable[list[dict]], latencies: dict, oversized: list[str]) -> Iterator[list[dict]]:
+    """Pass on the test cases the processor can finish before it times out.
+    The ids of the others are added to oversized: queued, they would time out on every delivery.
+    """
+    for test_case in test_cases:
+        seconds = estimate_test_case_seconds(test_case, latencies)
+        if seconds > PROCESSOR_TIMEOUT_SECONDS:
+            logger.warning('Test case %s is estimated at %.0f seconds, over the processor timeout of %.0f seconds, not queued',
+                           test_case[0]['test_case'], seconds, PROCESSOR_TIMEOUT_SECONDS)
+            oversized.append(test_case[0]['test_case'])
+            continue
+        yield test_case
+
+
+def send_messages(messages: Iterable[tuple[str, str]], skip: int = 0, checkpoint: Optional[Callable[[int], None]] = None) -> int:
+    """Send (queue_url, body) messages to their SQS queues in batches, returns the number of messages sent.
+    The first skip messages were sent by an earlier attempt of the run and are passed over. Every
+    CHECKPOINT_MESSAGES, whatever is waiting is sent and checkpoint is called with the number of messages
+    sent so far, skipped ones included, from where a later attempt can resume.
+    """
+    sent = 0
+    batches = {} # queue_url: (bodies, bytes) waiting to be sent
+
+    def flush(queue_url: str):
+        batch = batches.pop(queue_url)[0]
+        response = sqs_client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(i), 'MessageBody': body} for i, body in enumerate(batch)],
+        )
+        # retry anything the batch call rejected one message at a time
+        for failed in response.get('Failed', []):
+            logger.warning('Batch send failed for a message: %s, retrying', failed.get('Message'))
+            sqs_client.send_message(QueueUrl=queue_url, MessageBody=batch[int(failed['Id'])])
+
+    for index, (queue_url, body) in enumerate(messages):
+        if index < skip:
+            continue
+        size = len(body.encode('utf-8'))
+        batch, batch_bytes = batches.get(queue_url, ([], 0))
+        if batch and (len(batch) == MAX_BATCH_MESSAGES or batch_bytes + size > MAX_BATCH_BYTES):
+            flush(queue_url)
+            batch, batch_bytes = [], 0
+        batch.append(body)
+        batches[queue_url] = (batch, batch_bytes + size)
+        sent += 1
+        if checkpoint is not None and sent % CHECKPOINT_MESSAGES == 0:
+            for pending in list(batches):
+                flush(pending)
+            checkpoint(skip + sent)
+    for queue_url in list(batches):
+        flush(queue_url)
+    return sent
+
+
+def lane_queue_url(test_case: list[dict]) -> str:
+    """The queue a test case goes to: its bot's lane, or the shared test queue"""
+    return LANE_QUEUE_URLS.get(test_case[0].get('bot_id'), QUEUE_URL)
+
+
+def pack_stream(test_cases: Iterable[list[dict]], latencies: dict) -> Iterator[tuple[str, str]]:
+    """Pack test cases PACK_WINDOW at a time and yield (queue_url, body) messages, longest work first
+    in each window. Each message only holds test cases for one queue, see lane_queue_url.
+    Keeps memory flat for expanded templates, which are never held in full.
+    """
+    test_cases = iter(test_cases)
+    while True:
+        window = list(itertools.islice(test_cases, PACK_WINDOW))
+        if not window:
+            return
+        lanes = defaultdict(list)
+        for test_case in window:
+            lanes[lane_queue_url(test_case)].append(test_case)
+        for queue_url, lane in lanes.items():
+            for estimate, packed in pack_test_cases(lane, latencies):
+                logger.debug(f'Packed message with {len(packed)} test_cases (~{estimate:.1f} seconds)')
+                yield queue_url, json.dumps(packed)
+
+
+def load_template_values(bucket: str, template_values: dict) -> dict[str, list[str]]:
+    """Resolve placeholder values. Each value is a list, or a value file (s3://bucket/key or a key in
+    the suite's bucket) with one value per line.
+    """
+    values = {}
+    for name, source in template_values.items():
+        if isinstance(source, list):
+            values[name] = [str(value) for value in source]
+            continue
+        value_bucket, value_key = source[5:].split('/', 1) if source.startswith('s3://') else (bucket, source)
+        response = s3_client.get_object(Bucket=value_bucket, Key=value_key)
+        lines = response['Body'].read().decode('utf-8').splitlines()
+        values[name] = [line.strip() for line in lines if line.strip()]
+        logger.info('Loaded %d values for {%s} from %s', len(values[name]), name, source)
+    return values
+
+
+def template_placeholders(test_case: list[dict], values: dict) -> list[str]:
+    """Placeholders with known values used anywhere in a test_case, in order of appearance"""
+    names = []
+    for step in test_case:
+        for field in step.values():
+            if isinstance(field, str):
+                names.extend(name for name in PLACEHOLDER.findall(field) if name in values and name not in names)
+    return names
+
+
+def pairwise_combinations(sizes: list[int]) -> list[tuple[int, ...]]:
+    """Value indexes covering every pair of values of every two placeholders (in-parameter-order greedy)"""
+    if len(sizes) < 2:
+        return [(i,) for i in range(sizes[0])] if sizes else [()]
+
+    # grow from the largest placeholders, since they bound the number of combinations
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+    tests = [[a, b] for a in range(sizes[order[0]]) for b in range(sizes[order[1]])]
+    for column in range(2, len(order)):
+        size = sizes[order[column]]
+        uncovered = {(j, a, b) for j in range(column) for a in range(sizes[order[j]]) for b in range(size)}
+
+        # horizontal growth: extend each combination with the value covering the most new pairs
+        for test in tests:
+            best = max(range(size), key=lambda b: sum((j, test[j], b) in uncovered for j in range(column)))
+            test.append(best)
+            uncovered.difference_update((j, test[j], best) for j in range(column))
+
+        # vertical growth: add combinations for the pairs still uncovered
+        extra = []
+        for j, a, b in sorted(uncovered):
+            for test in extra:
+                if test[column] == b and test[j] is None:
+                    test[j] = a
+                    break
+            else:
+                test = [None] * (column + 1)
+                test[j], test[column] = a, b
+                extra.append(test)
+        tests.extend([value or 0 for value in test] for test in extra)
+
+    # put the indexes back in placeholder order
+    return [tuple(test[order.index(i)] for i in range(len(sizes))) for test in tests]
+
+
+def expand_template(test_case: list[dict], values: dict, sampling: str = None, max_cases: int = None, seed: int = 0) -> Iterator[list[dict]]:
+    """Lazily expand a template test_case over its placeholder values.
+
+    sampling: None for the full cross product, 'random' for max_cases random combinations,
+        'pairwise' for combinations covering every pair of values (capped at max_cases).
+    Expanded test_cases are numbered by their position in the cross product, so the same
+    combination keeps the same test_case id from run to run.
+    """
+    names = template_placeholders(test_case, values)
+    lists = [values[name] for name in names]
+    sizes = [len(value_list) for value_list in lists]
+    total = math.prod(sizes)
+
+    if sampling == 'pairwise':
+        indexes = (sum(digit * math.prod(sizes[i + 1:]) for i, digit in enumerate(digits)) for digits in pairwise_combinations(sizes))
+        indexes = itertools.islice(indexes, max_cases)
+    elif sampling == 'random' and max_cases is not None and max_cases < total:
+        indexes = iter(sorted(random.Random(seed).sample(range(total), max_cases)))
+    else:
+        indexes = itertools.islice(range(total), max_cases)
+
+    for index in indexes:
+        # decode the index into one value per placeholder, last placeholder varying fastest
+        binding, remainder = {}, index
+        for name, value_list in zip(reversed(names), reversed(lists)):
+            remainder, digit = divmod(remainder, len(value_list))
+            binding[name] = value_list[digit]
+
+        def substitute(match):
+            return binding.get(match.group(1), match.group(0))
+
+        expanded = []
+        for step in test_case:
+            row = {key: PLACEHOLDER.sub(substitute, field) if isinstance(field, str) else field for key, field in step.items()}
+            row['test_case'] = f'{step["test_case"]}-{index}'
+            expanded.append(row)
+        yield expanded
+
+
+def target_label(target: dict) -> str:
+    """Name of a target in test_case ids and results, its 'name' or its bot/alias/locale/region"""
+    return target.get('name') or '/'.join(str(target[field]) for field in TARGET_FIELDS if target.get(field))
+
+
+def expand_targets(test_cases: Iterable[list[dict]], targets: list[dict]) -> Iterator[list[dict]]:
+    """Yield a copy of every test_case for each target, with the target's bot_id, alias_id, locale_id and region.
+
+    The copies of a case are yielded together so each packing window holds every target, and the
+    processor works on all of them side by side. Copies are numbered {test_case}@{target}.
+    """
+    for test_case in test_cases:
+        for target in targets:
+            label = target_label(target)
+            overrides = {field: str(target[field]) for field in TARGET_FIELDS if target.get(field)}
+            yield [{**step, **overrides, 'test_case': f'{step["test_case"]}@{label}', 'target': label} for step in test_case]
+
+
+def step_failed(step: dict) -> bool:
+    """A step fails when Lex errored or the codehook graded it anything but a pass.
+    Without a grade, the recognized intent has to match the expected one.
+    """
+    if 'Error' in step:
+        return True
+    if step.get('test_result'):
+        return step['test_result'].lower() not in ('pass', 'passed', 'true')
+    return bool(step.get('expected_intent')) and 'actual_intent' in step and step['actual_intent'] != step['expected_intent']
+
+
+def changed_intents(bot_id: str, locale_id: str, from_version: str, to_version: str) -> set[str]:
+    """Names of intents added, removed or changed between two versions of a bot"""
+
+    def definitions(version: str) -> dict[str, str]:
+        intents, kwargs = {}, {}
+        while True:
+            response = lex_models_client.list_intents(botId=bot_id, botVersion=version, localeId=locale_id, **kwargs)
+            for summary in response.get('intentSummaries', []):
+                intent = lex_models_client.describe_intent(
+                    intentId=summary['intentId'], botId=bot_id, botVersion=version, localeId=locale_id
+                )
+                # only the definition matters, not when or in which version it was saved
+                for ignored in ('ResponseMetadata', 'botVersion', 'creationDateTime', 'lastUpdatedDateTime'):
+                    intent.pop(ignored, None)
+                intents[summary['intentName']] = json.dumps(intent, sort_keys=True, default=str)
+            if not response.get('nextToken'):
+                return intents
+            kwargs = {'nextToken': response['nextToken']}
+
+    before, after = definitions(from_version), definitions(to_version)
+    changed = {name for name in before.keys() | after.keys() if before.get(name) != after.get(name)}
+    logger.info('Intents changed between versions %s and %s of bot %s: %s', from_version, to_version, bot_id, sorted(changed))
+    return changed
+
+
+def invoke_processor(body: str) -> list[list[dict]]:
+    """Run one message through the processor synchronously and return its results"""
+    event = {'Records': [{'messageId': 'smoke', 'body': body}]}
+    response = lambda_client.invoke(FunctionName=PROCESSOR_FUNCTION_NAME, InvocationType='RequestResponse', Payload=json.dumps(event))
+    payload = json.loads(response['Payload'].read())
+    if response.get('FunctionError'):
+        raise RuntimeError(f'Smoke test invocation failed: {payload}')
+    return payload
+
+
+def prewarm_concurrency(cases: int, seconds: float, cases_per_second: float) -> int:
+    """Estimate how many processor containers a run of cases, estimated at seconds in total, needs to
+    reach cases_per_second.
+
+    A container works through one message at a time, so it runs about one case per estimated
+    case duration. More containers than the run has messages would never get any work.
+    """
+    if not cases:
+        return 0
+    needed = math.ceil(cases_per_second * seconds / cases)
+    return min(needed, math.ceil(seconds / MESSAGE_BUDGET_SECONDS), PREWARM_MAX_CONCURRENCY)
+
+
+def prewarm_ahead(test_cases: Iterable[list[dict]], latencies: dict, cases_per_second: float, warmups: list) -> Iterator[list[dict]]:
+    """Pass test cases through PACK_WINDOW at a time, first starting the processor containers the
+    cases queued so far need, so the containers are up before the window's messages arrive.
+    Only what is actually queued is counted: expanded templates and targets, after the filters,
+    the delta and the smoke tests. The number of warm-ups sent for each window is added to warmups.
+    """
+    test_cases = iter(test_cases)
+    cases, seconds = 0, 0.0
+    while True:
+        window = list(itertools.islice(test_cases, PACK_WINDOW))
+        if not window:
+            return
+        cases += len(window)
+        seconds += sum(estimate_test_case_seconds(test_case, latencies) for test_case in window)
+        # a single container is started by the first message anyway
+        needed = prewarm_concurrency(cases, seconds, cases_per_second)
+        if needed > 1 and needed > sum(warmups):
+            warmups.append(prewarm_processor(needed - sum(warmups)))
+        yield from window
+
+
+def prewarm_processor(concurrency: int) -> int:
+    """Start concurrency processor containers ahead of the run with warm-up invocations, which the processor
+    returns from right away after holding its container for WARMUP_HOLD_MS so the others land on new ones.
+    Returns the number of warm-up invocations sent.
+    """
+    payload = json.dumps({'warmup': True, 'hold_ms': WARMUP_HOLD_MS})
+    sent = 0
+    for _ in range(concurrency):
+        try:
+            lambda_client.invoke(FunctionName=PROCESSOR_FUNCTION_NAME, InvocationType='Event', Payload=payload)
+            sent += 1
+        except Exception as e:
+            # warming up is best effort, the run doesn't depend on it
+            logger.warning('Warm-up invocation failed, not pre-warming further: %s', e)
+            break
+    logger.info('Pre-warmed %d processor containers', sent)
+    return sent
+
+
+def run_smoke_tests(test_cases: Iterable[list[dict]], latencies: dict) -> tuple[int, int]:
+    """Run test cases through the processor right away, returns (test cases run, test cases failed)"""
+    bodies = [body for _, body in pack_stream(test_cases, latencies)]
+    with ThreadPoolExecutor(max_workers=SMOKE_CONCURRENCY) as executor:
+        results = [test_case for test_cases in executor.map(invoke_processor, bodies) for test_case in test_cases]
+    failed = sum(1 for test_case in results if any(step_failed(step) for step in test_case))
+    return len(results), failed
+
+
+def write_batches(bucket: str, test_run: str, bodies: Iterable[str]) -> tuple[str, int]:
+    """Write packed messages as JSON Lines in the shape of SQS records, for the state machine's Distributed Map.
+    The lines are uploaded in parts of BATCHES_PART_BYTES as they are packed, so memory stays flat
+    for expanded templates. Batches smaller than one part are written with a single put_object.
+
+    Returns:
+    tuple[str, int]: the S3 key of the batches and the number of messages in it
+    """
+    key = f'{RUNS_PREFIX}/batches/{test_run}.jsonl'
+    upload_id, parts = None, []
+    buffer, count = io.BytesIO(), 0
+
+    def upload_part():
+        nonlocal upload_id
+        if upload_id is None:
+            upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        response = s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1, Body=buffer.getvalue())
+        parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+        buffer.seek(0)
+        buffer.truncate()
+
+    try:
+        for index, body in enumerate(bodies):
+            line = json.dumps({'messageId': f'{test_run}-{index}', 'body': body})
+            buffer.write(('\n' if index else '').encode('utf-8') + line.encode('utf-8'))
+            count += 1
+            if buffer.tell() >= BATCHES_PART_BYTES:
+                upload_part()
+        if upload_id is None:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+            return key, count
+        if buffer.tell():
+            upload_part()
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        # don't leave the parts behind, they are billed until the upload is aborted
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return key, count
+
+
+def run_key(bucket: str, key: str, version_id: str, etag: str, options: dict, suites: list = None) -> str:
+    """Identify a run by the object version it reads and the options it runs with.
+    For a manifest, suites are the versions of the suites it lists (see manifest_suites).
+    """
+    identity = json.dumps([bucket, key, version_id or '', (etag or '').strip('"'), options, suites or []], sort_keys=True, default=str)
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def put_marker(bucket: str, run_id: str, marker: dict, **condition) -> bool:
+    """Write a run marker, returns False when the condition (IfNoneMatch or IfMatch) didn't hold"""
+    try:
+        s3_client.put_object(Bucket=bucket, Key=f'{RUNS_PREFIX}/{run_id}.json', Body=json.dumps(marker), **condition)
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+    return True
+
+
+def claim_run(bucket: str, run_id: str, marker: dict) -> tuple[bool, dict]:
+    """Record a run this invocation is about to do. Returns (claimed, the run's marker).
+
+    A new run is claimed with marker. A run recorded before is claimed again only if it stopped
+    before completing: its invocation failed, or is past its deadline so it timed out. The marker
+    returned then has its test_run and the messages_sent to resume from. Any other run is a
+    duplicate event, returned unclaimed with its marker.
+    """
+    # conditional writes, only one invocation can create or take over the marker
+    if put_marker(bucket, run_id, marker, IfNoneMatch='*'):
+        return True, marker
+    response = s3_client.get_object(Bucket=bucket, Key=f'{RUNS_PREFIX}/{run_id}.json')
+    previous = json.loads(response['Body'].read())
+    if previous['status'] == 'completed' or time.time() < previous['deadline']:
+        return False, previous
+    resumed = {**previous, 'status': 'started', 'deadline': marker['deadline'], 'attempts': previous.get('attempts', 1) + 1}
+    if put_marker(bucket, run_id, resumed, IfMatch=response['ETag']):
+        return True, resumed
+    return False, previous
+
+
+def update_run(bucket: str, run_id: str, marker: dict, **changes):
+    """Record the progress of a run this invocation claimed"""
+    marker.update(changes)
+    put_marker(bucket, run_id, marker)
+
+
+def test_case_hash(test_case: list[dict]) -> str:
+    """Hash the content of a test_case, leaving out what is specific to a run"""
+    steps = [{k: v for k, v in step.items() if k not in RUN_FIELDS} for step in test_case]
+    return hashlib.sha256(json.dumps(steps, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def suite_hashes_key(bucket: str, key: str) -> str:
+    suite = hashlib.sha256(f'{bucket}/{key}'.encode('utf-8')).hexdigest()[:16]
+    return f'{RUNS_PREFIX}/suites/{suite}.json.gz'
+
+
+def load_suite_hashes(bucket: str, key: str) -> dict[str, str]:
+    """Test case hashes from the previous runs of a suite, empty for a new suite"""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=suite_hashes_key(bucket, key))
+        return json.loads(gzip.decompress(response['Body'].read()))
+    except Exception as e:
+        logger.info('No previous run of s3://%s/%s: %s', bucket, key, e)
+        return {}
+
+
+def save_suite_hashes(bucket: str, key: str, hashes: dict[str, str]):
+    body = gzip.compress(json.dumps(hashes).encode('utf-8'))
+    s3_client.put_object(Bucket=bucket, Key=suite_hashes_key(bucket, key), Body=body)
+
+
+def track_changes(test_cases: Iterable[list[dict]], hashes: dict[str, str], delta: bool) -> Iterator[list[dict]]:
+    """Update hashes, those of the previous tracked run, with every test case passed on.
+    With delta, drop those unchanged since then.
+    """
+    for test_case in test_cases:
+        test_number = test_case[0]['test_case']
+        digest = test_case_hash(test_case)
+        if delta and hashes.get(test_number) == digest:
+            continue
+        hashes[test_number] = digest
+        yield test_case
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+PARQUET_MAGIC = b'PAR1'
+
+# column names used by the suite template in docs/, mapped to the field names the pipeline uses
+COLUMN_ALIASES = {'botid': 'bot_id', 'aliasid': 'alias_id', 'localeid': 'locale_id'}
+
+
+class PeekableStream:
+    """Wraps a readable stream so its first bytes can be inspected without consuming them"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b''
+
+    def peek(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = self.stream.read(size - len(self.buffer))
+            if not chunk:
+                break
+            self.buffer += chunk
+        return self.buffer[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        if self.buffer:
+            if size is None or size < 0:
+                data, self.buffer = self.buffer + self.stream.read(), b''
+            else:
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
+
+
+def decompress_stream(stream: PeekableStream, key: str) -> PeekableStream:
+    """Decompress gzip or zstd, detected by extension or magic bytes, as the stream is read"""
+    magic = stream.peek(4)
+    if key.endswith('.gz') or magic.startswith(GZIP_MAGIC):
+        return PeekableStream(gzip.GzipFile(fileobj=stream))
+    if key.endswith('.zst') or magic == ZSTD_MAGIC:
+        try:
+            import zstandard # type: ignore
+            return PeekableStream(zstandard.ZstdDecompressor().stream_reader(stream))
+        except ImportError:
+            pass
+        try:
+            from compression import zstd # type: ignore # Python 3.14+
+            return PeekableStream(zstd.ZstdFile(stream))
+        except ImportError:
+            raise ValueError('zstd compressed suites need the zstandard package (or Python 3.14+)', key)
+    return stream
+
+
+@functools.lru_cache(maxsize=256)
+def column_name(column: str) -> str:
+    """Snake case column name, as the pipeline calls it"""
+    name = column.strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(name, name)
+
+
+def normalize_row(row: dict) -> dict:
+    """Snake case column names and string values, whatever the input format"""
+    normalized = {}
+    for column, value in row.items():
+        if column is None: # extra values on a CSV line
+            continue
+        name = column_name(column)
+        if value is None:
+            value = ''
+        elif isinstance(value, dict): # session attributes given as an object
+            value = ''.join(f'{k}={v},' for k, v in value.items())
+        normalized[name] = str(value)
+    return normalized
+
+
+def read_rows(stream, key: str) -> Iterator[dict]:
+    """Decode a suite as it is read: CSV, JSON Lines or Parquet, optionally gzip or zstd compressed"""
+    stream = decompress_stream(PeekableStream(stream), key)
+    name = key[:-len('.gz')] if key.endswith('.gz') else key[:-len('.zst')] if key.endswith('.zst') else key
+
+    if name.endswith('.parquet') or stream.peek(4) == PARQUET_MAGIC:
+        try:
+            import pyarrow.parquet as pq # type: ignore
+        except ImportError:
+            raise ValueError('Parquet suites need the pyarrow package', key)
+        # the footer is at the end of the file, so it is spooled to disk (not memory) first,
+        # then row groups are decoded one batch at a time
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(stream, spool, SPOOL_CHUNK_BYTES)
+            spool.seek(0)
+            for batch in pq.ParquetFile(spool).iter_batches():
+                for row in batch.to_pylist():
+                    yield normalize_row(row)
+        return
+
+    lines = codecs.getreader('utf-8-sig')(stream)
+    if name.endswith(('.jsonl', '.ndjson')) or stream.peek(1) == b'{':
+        for line in lines:
+            if line.strip():
+                yield normalize_row(json.loads(line))
+        return
+
+    for row in csv.DictReader(lines):
+        yield normalize_row(row)
+
+
+def natural_key(test_number: str) -> list:
+    """Sort key that orders numbers within test_case ids by value, e.g. 2 before 10"""
+    return [int(part) if part.isdigit() else part for part in NUMBERS.split(test_number)]
+
+
+def is_sorted(rows: Iterable[dict]) -> bool:
+    """Whether the rows of every suite are sorted by test_case (in natural order), so every test case's
+    rows are together. A manifest's suites are sorted on their own, their test_cases never mix.
+    """
+    previous, suite = None, None
+    for row in rows:
+        current = natural_key(row['test_case'])
+        if row.get('s3_path') != suite:
+            previous, suite = None, row.get('s3_path')
+        if previous is not None and current < previous:
+            logger.warning('Test case %s comes after a later one, the suite is not sorted', row['test_case'])
+            return False
+        previous = current
+    return True
+
+
+def group_test_cases(rows: Iterable[dict], sorted_rows: bool) -> Iterator[list[dict]]:
+    """Group rows into test cases. A sorted suite is grouped as it streams in, with one test case in
+    memory at a time. Any other suite is held in full before its first test case is passed on.
+    """
+    if sorted_rows:
+        for _, test_case in itertools.groupby(rows, key=operator.itemgetter('test_case')):
+            yield list(test_case)
+        return
+    grouped_tests = defaultdict(list)
+    for row in rows:
+        grouped_tests[row['test_case']].append(row)
+    yield from grouped_tests.values()
+
+
+def manifest_suites(bucket: str, manifest: dict) -> list[list[str]]:
+    """[bucket, key, version_id, etag] of every suite listed in a manifest, as they are now.
+    Suites are s3://bucket/key paths or keys in the manifest's bucket.
+    """
+    suites = []
+    for suite in manifest['suites']:
+        suite_bucket, suite_key = suite[5:].split('/', 1) if suite.startswith('s3://') else (bucket, suite)
+        response = s3_client.head_object(Bucket=suite_bucket, Key=suite_key)
+        suites.append([suite_bucket, suite_key, response.get('VersionId') or '', response.get('ETag', '').strip('"')])
+    return suites
+
+
+def read_manifest(suites: list[list[str]]) -> Iterator[dict]:
+    """Rows of every suite listed in a manifest, at the versions manifest_suites found.
+    With more than one suite, test_cases are prefixed with their suite's file name to keep them apart.
+    """
+    for suite_bucket, suite_key, version_id, _ in suites:
+        logger.info('Reading suite s3://%s/%s', suite_bucket, suite_key)
+        response = s3_client.get_object(Bucket=suite_bucket, Key=suite_key, **({'VersionId': version_id} if version_id else {}))
+        name = suite_key.rsplit('/', 1)[-1].split('.', 1)[0]
+        for row in read_rows(response['Body'], suite_key):
+            row['s3_path'] = f's3://{suite_bucket}/{suite_key}'
+            if len(suites) > 1:
+                row['test_case'] = f'{name}/{row["test_case"]}'
+            yield row
+
+
+def label_test_cases(grouped_tests: Iterable[list[dict]], event: dict, s3_path: str, test_run: str) -> Iterator[list[dict]]:
+    """Add the run, the suite and the run options to every step"""
+    for test_case in grouped_tests:
+        for row in test_case:
+            row['test_run'] = test_run
+            row.setdefault('s3_path', s3_path)
+            for option in RUN_OPTIONS:
+                if option in event:
+                    row[option] = event[option]
+        logger.debug('Test case: %s', test_case)
+        yield test_case
+
+
+def expand_templates(grouped_tests: Iterable[list[dict]], values: dict, event: dict, counts: Counter) -> Iterator[list[dict]]:
+    """Pass test cases on, expanding templates where they are. counts gets the test_cases and templates seen"""
+    for test_case in grouped_tests:
+        if not template_placeholders(test_case, values):
+            counts['test_cases'] += 1
+            yield test_case
+            continue
+        counts['templates'] += 1
+        yield from expand_template(
+            test_case,
+            values,
+            sampling=event.get('template_sampling'),
+            max_cases=event.get('template_max_cases'),
+            seed=event.get('template_seed', 0),
+        )
+
 
 # Event will be CSV as plain text
 def handler(event, context):
     """
     Expects event with the following keys:
-    's3_path': An S3 path ot the CSV file. Format: s3://bucket/key
+    's3_path': An S3 path ot the suite (CSV, JSON Lines or Parquet, optionally .gz or .zst) or a manifest. Format: s3://bucket/key
+        A manifest is a *.manifest.json file such as {"suites": ["suites/a.csv.gz", "s3://bucket/b.parquet"], "options": {...}}
+        Its options are used like the keys below, which take precedence.
+    Optional keys:
+    'lex_mode': live, record or replay. Overrides the processor's LEX_MODE for this run
+    'replay_run': The test_run whose recorded Lex responses are replayed. Required when replaying
+    'template_values': Values for {placeholder}s in template rows, e.g. {"city": ["Boston", "Denver"]}
+        or {"city": "s3://bucket/cities.txt"} (one value per line)
+    'template_sampling': random or pairwise, to cover templates with fewer cases than the cross product
+    'template_max_cases': Maximum number of cases expanded from each template
+    'targets': Run every test case against each of these targets, e.g.
+        [{"alias_id": "PRODALIAS"}, {"alias_id": "TSTALIASID", "locale_id": "en_GB"}, {"bot_id": "...", "region": "us-west-2", "name": "west"}]
+        Targets can set bot_id, alias_id, locale_id and region, and a name to label their results
+    'intents': Only run test cases expecting one of these intents
+    'changed_intents': Only run test cases expecting an intent that differs between two bot versions,
+        e.g. {"bot_id": "...", "locale_id": "en_US", "from_version": "3", "to_version": "DRAFT"}
+    'smoke_cases': Run this many test cases first, and stop if too many of them fail
+    'smoke_max_failure_rate': Failure rate (0-1) of the smoke cases above which the run stops. Default 0.5
+    'fail_fast': End each conversation at its first failing step
+    'delta': Only queue test cases that are new or changed since the previous tracked run of the same suite
+    'track_changes': Record what every test case looked like, for a later delta run. Delta runs always do
+    'force': Start the run even if this object version already ran with the same options, from the start
+    'prewarm_cases_per_second': Throughput target the processor is pre-warmed for. Default PREWARM_CASES_PER_SECOND, 0 to not pre-warm
+    'orchestration': sqs (default) or stepfunctions, to write the packed messages to S3 for the state machine
+    The state machine invokes the initializer with {"orchestration": "stepfunctions", "run": <its own input>},
+    its input being the run request above or the EventBridge S3 event.
     """
 
     logger.debug('Event Received: %s', event)
 
+    if 'run' in event:
+        event = {**event['run'], 'orchestration': event.get('orchestration', 'sqs')}
+
     test_run = datetime.datetime.now().isoformat()
+    detail = event.get('detail', {}).get('object', {})
 
     # Determine bucket and key based on the event Type
     if 's3_path' in event:
@@ -49,30 +848,170 @@ def handler(event, context):
     else:
         raise ValueError('Invalid event format. Missing "s3_path" or EventBridge S3 details')
 
-    # Download the CSV file from S3
-    logger.info('Downloading CSV file from S3 bucket: %s, key: %s', bucket, key)
-    response = s3_client.get_object(Bucket=bucket, Key=key)
-    csv_content = response['Body'].read().decode('utf-8')
-    logger.info('CSV file downloaded successfully: %s', s3_path)
-
-    # Parse the CSV file and group records by test_case
-    grouped_tests = defaultdict(list) # Initialize an empty dictionary to store grouped tests
-    csv_reader = csv.DictReader(csv_content.splitlines())
-    for row in csv_reader:
-        test_number = row['test_case']
-        row['test_run'] = test_run
-        row['s3_path'] = s3_path
-        grouped_tests[test_number].append(row)
-
-    logger.info('Grounded tests: %s', json.dumps(grouped_tests, indent=4))
-
-    # Send grouped tests to SQS queue
-    for test_number, test_step in grouped_tests.items():
-        message_body = json.dumps(test_step)
-        sqs_client.send_message(QueueUrl=QUEUE_URL, MessageBody=message_body)
-        logger.info(f'Sent message for test_case {test_number} to SQS queue')
+    # Download the suite from S3
+    logger.info('Downloading suite from S3 bucket: %s, key: %s', bucket, key)
+    response = s3_client.get_object(Bucket=bucket, Key=key, **({'VersionId': detail['version-id']} if 'version-id' in detail else {}))
+
+    # A manifest's run also depends on the suites it lists, which can change without the manifest
+    manifest, suites = None, None
+    if key.endswith('manifest.json'):
+        manifest = json.loads(response['Body'].read())
+        suites = manifest_suites(bucket, manifest)
+
+    # Events are delivered at least once, only the first one for an object version starts a run
+    options = {option: value for option, value in event.items() if option not in ('s3_path', 'force')} if 's3_path' in event else {}
+    run_id = run_key(bucket, key, detail.get('version-id', response.get('VersionId')), detail.get('etag', response.get('ETag')), options, suites)
+    # A retry of a run that stopped partway resumes it after the messages it already sent
+    force = event.get('force', False)
+    deadline = time.time() + (context.get_remaining_time_in_millis() / 1000 if context is not None else INITIALIZER_TIMEOUT_SECONDS)
+    marker = {'test_run': test_run, 's3_path': s3_path, 'options': options, 'status': 'started', 'messages_sent': 0, 'deadline': deadline}
+    if not force:
+        claimed, marker = claim_run(bucket, run_id, marker)
+        if not claimed:
+            logger.warning('Run %s for %s is %s, ignoring duplicate event', run_id, s3_path, marker['status'])
+            return {
+                'statusCode': 200,
+                'Message': 'Duplicate run ignored',
+                'run_key': run_id,
+                'status': marker['status'],
+                'test_run': marker['test_run'],
+            }
+        if marker['test_run'] != test_run:
+            logger.warning('Resuming run %s (%s) after %d messages', marker['test_run'], s3_path, marker['messages_sent'])
+            test_run = marker['test_run']
+
+    def checkpoint(messages_sent: int):
+        update_run(bucket, run_id, marker, messages_sent=messages_sent)
+
+    bodies = [response['Body']] # the first pass reads the body already open
+    def open_rows() -> Iterator[dict]:
+        """Read the suite (or the manifest's suites) from the start, at the version this run started with"""
+        if manifest is not None:
+            return read_manifest(suites)
+        if bodies:
+            return read_rows(bodies.pop(), key)
+        version = {'VersionId': response['VersionId']} if response.get('VersionId') else {}
+        return read_rows(s3_client.get_object(Bucket=bucket, Key=key, **version)['Body'], key)
+
+    try:
+        if manifest is not None:
+            event = {**manifest.get('options', {}), **event}
+        # A first pass only checks the order of the rows, so a sorted suite can be grouped as it streams in
+        sorted_rows = is_sorted(open_rows())
+        result = run_suite(event, bucket, key, s3_path, group_test_cases(open_rows(), sorted_rows), test_run,
+                           resume_from=marker['messages_sent'], checkpoint=None if force else checkpoint)
+    except Exception:
+        if not force:
+            # no need for a retry to wait for the deadline
+            update_run(bucket, run_id, marker, status='failed', deadline=0)
+        raise
+    if not force:
+        update_run(bucket, run_id, marker, status='completed', messages_sent=result.get('messages', 0))
+
+    result['run_key'] = run_id
+    return result
+
+
+def run_suite(event: dict, bucket: str, key: str, s3_path: str, grouped_tests: Iterable[list[dict]], test_run: str,
+              resume_from: int = 0, checkpoint: Optional[Callable[[int], None]] = None) -> dict:
+    """Select the suite's test cases as they are read and queue them up.
+    A resumed run passes over the first resume_from messages, and its smoke tests, which already passed.
+    checkpoint is called with the messages sent so far, see send_messages.
+    """
+
+    # a new run has no cassettes of its own to replay
+    if event.get('lex_mode', LEX_MODE) == 'replay' and not event.get('replay_run'):
+        raise ValueError('lex_mode replay needs a replay_run, the test_run whose recorded Lex responses are replayed')
+
+    # Label every step with the run it belongs to
+    grouped_tests = label_test_cases(grouped_tests, event, s3_path, test_run)
+
+    # Template test cases are expanded on the fly
+    values = load_template_values(bucket, event.get('template_values', {}))
+    counts = Counter()
+    test_cases = expand_templates(grouped_tests, values, event, counts)
+
+    # Run the suite against every target of the matrix
+    targets = event.get('targets')
+    if targets:
+        logger.info('Expanding test cases for %d targets: %s', len(targets), [target_label(target) for target in targets])
+        test_cases = expand_targets(test_cases, targets)
+
+    # Only run the test cases for the intents asked for
+    intents = set(event.get('intents', []))
+    if 'changed_intents' in event:
+        versions = event['changed_intents']
+        intents |= changed_intents(versions['bot_id'], versions['locale_id'], versions['from_version'], versions['to_version'])
+    if 'intents' in event or 'changed_intents' in event:
+        test_cases = (test_case for test_case in test_cases if any(step.get('expected_intent') in intents for step in test_case))
+
+    # Leave out the test cases that would time out in the processor on every delivery
+    latencies = load_step_latencies(bucket)
+    oversized = []
+    test_cases = within_timeout(test_cases, latencies, oversized)
+
+    # Remember what each test case looked like, and for a delta rerun skip the unchanged ones.
+    # Only done when asked for, as it holds a hash for every test case of the suite
+    delta = event.get('delta', False)
+    hashes = None
+    if delta or event.get('track_changes', False):
+        hashes = load_suite_hashes(bucket, key)
+        test_cases = track_changes(test_cases, hashes, delta)
+
+    # Run a smoke subset first and stop if it is already failing
+    smoke_cases = event.get('smoke_cases', 0)
+    if smoke_cases and resume_from:
+        # the same cases are left out of the queue again
+        for _ in itertools.islice(test_cases, smoke_cases):
+            pass
+    elif smoke_cases:
+        run, failed = run_smoke_tests(itertools.islice(test_cases, smoke_cases), latencies)
+        failure_rate = failed / run if run else 0.0
+        logger.info('Smoke tests: %d of %d test_cases failed', failed, run)
+        if failure_rate > event.get('smoke_max_failure_rate', 0.5):
+            logger.warning('Smoke test failure rate %.0f%% is over the threshold, stopping the run', failure_rate * 100)
+            if hashes is not None:
+                save_suite_hashes(bucket, key, hashes)
+            return {
+                'statusCode': 200,
+                'Message': 'Smoke tests failed, run stopped',
+                'smoke_cases': run,
+                'smoke_failures': failed,
+            }
+
+    # Start the processor containers the run will need ahead of its messages
+    cases_per_second = float(event.get('prewarm_cases_per_second', PREWARM_CASES_PER_SECOND))
+    warmups = []
+    if cases_per_second > 0:
+        test_cases = prewarm_ahead(test_cases, latencies, cases_per_second, warmups)
+
+    # Pack tests into messages for the state machine, longest work first
+    if event.get('orchestration') == 'stepfunctions':
+        batches_key, sent = write_batches(bucket, test_run, (body for _, body in pack_stream(test_cases, latencies)))
+        logger.info('Wrote %d messages to s3://%s/%s for the state machine', sent, bucket, batches_key)
+        if hashes is not None:
+            save_suite_hashes(bucket, key, hashes)
+        return {
+            'statusCode': 200,
+            'Message': 'Processing complete',
+            'batches_bucket': bucket,
+            'batches_key': batches_key,
+            'messages': sent,
+            'prewarmed': sum(warmups),
+            'oversized_cases': oversized,
+        }
+
+    # Pack tests into messages and stream them to the SQS queue, longest work first
+    sent = send_messages(pack_stream(test_cases, latencies), skip=resume_from, checkpoint=checkpoint)
+    logger.info('Sent %d messages for %d test_cases and %d templates to SQS queue', sent, counts['test_cases'], counts['templates'])
+    if hashes is not None:
+        save_suite_hashes(bucket, key, hashes)
 
     return {
         'statusCode': 200,
-        'Message': 'Processing complete'
+        'Message': 'Processing complete',
+        'messages': resume_from + sent,
+        'resumed_from': resume_from,
+        'prewarmed': sum(warmups),
+        'oversized_cases': oversized,
     }
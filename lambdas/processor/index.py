@@ -2,19 +2,46 @@ import os
 import logging
 import boto3
 import datetime
+import gzip
+import hashlib
 import uuid
 import json
+import threading
 import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 QUEUE_URL = os.environ.get('QUEUE_URL')
+# messages that fail their last allowed receive are moved here, with the reason they failed
+DLQ_URL = os.environ.get('DLQ_URL')
+MAX_RECEIVE_COUNT = int(os.environ.get('MAX_RECEIVE_COUNT', '3'))
 FIREHOSE_NAME = os.environ.get('FIREHOSE_NAME')
+RESULTS_BUCKET = os.environ.get('RESULTS_BUCKET')
+CASSETTE_PREFIX = os.environ.get('CASSETTE_PREFIX', 'cassettes')
+# live: call Lex, record: call Lex and store every exchange, replay: serve stored exchanges instead of calling Lex
+# (replay needs the run's replay_run)
+LEX_MODE = os.environ.get('LEX_MODE', 'live')
+# end a conversation at its first failing step (a run can turn this on with fail_fast)
+FAIL_FAST = os.environ.get('FAIL_FAST', 'false').lower() == 'true'
+# compact per-run index of results, used to diff runs without scanning the raw results
+INDEX_PREFIX = os.environ.get('INDEX_PREFIX', 'index')
+# per bot caps within one invocation, so a slow bot doesn't hold up the others in the same message:
+# conversations run side by side for one bot, and Lex calls per second to one bot (0 for no limit).
+# Every concurrent invocation applies them on its own; the fleet-wide cap for a bot is its lane
+# (a queue of its own, see the initializer's LANE_QUEUE_URLS) with a maximum concurrency
+INVOCATION_BOT_CONCURRENCY = int(os.environ.get('INVOCATION_BOT_CONCURRENCY', '1'))
+INVOCATION_BOT_RATE_LIMIT = float(os.environ.get('INVOCATION_BOT_RATE_LIMIT', '0'))
+# overrides for specific bots, e.g. {"BOTID": {"concurrency": 4, "rate": 10}}
+INVOCATION_BOT_LIMITS = json.loads(os.environ.get('INVOCATION_BOT_LIMITS') or '{}')
 
 logging.basicConfig(level=os.environ.get('LOGGING_LEVEL', 'DEBUG'))
 logger = logging.getLogger(__name__) # __name__ is the name of the module
 
+s3_client = boto3.client('s3')
 sqs_client = boto3.client('sqs')
 firehose_client = boto3.client('firehose')
-lex_client = boto3.client('lex-runtime')
+lex_client = boto3.client('lexv2-runtime') # recognize_text is a Lex V2 API
+lex_clients = {} # clients for targets in other regions, created when first needed
 
 # set a unique identifier for this test run (stored as Lex session attribute)
 test_run_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
@@ -22,6 +49,12 @@ test_run_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 # set request attribute for Lex test runs (stored as Lex request attribute)
 channel_attribute = 'lex lambda test analytics'
 
+# Firehose accepts at most 500 records per PutRecordBatch call
+FIREHOSE_BATCH_SIZE = 500
+
+# SQS message attribute values are limited in size, keep the recorded reason short
+MAX_FAILURE_REASON_LENGTH = 1000
+
 def flush_logs():
     """Flush all logging handlers to ensure all logs are sent to CloudWatch before sending to Lex.
     This is the process of ensuring that all buffered log data is written to the log file or storage medium immediately. This is important to prevent data loss, especially in cases of unexpected system crashes or shutdowns
@@ -30,8 +63,112 @@ def flush_logs():
         handler.flush()
 
 
+class RateLimiter:
+    """Spaces out calls to at most `rate` per second, shared by the threads calling one bot"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0.0
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+rate_limiters = {} # by (region, bot_id), kept across invocations of a warm container
+limits_lock = threading.Lock()
+
+
+def invocation_bot_limits(bot_id: str) -> tuple[int, float]:
+    """(concurrency, rate) caps for a bot within this invocation"""
+    limits = INVOCATION_BOT_LIMITS.get(bot_id, {})
+    return int(limits.get('concurrency', INVOCATION_BOT_CONCURRENCY)), float(limits.get('rate', INVOCATION_BOT_RATE_LIMIT))
+
+
+def rate_limiter(step: dict) -> RateLimiter:
+    key = (step.get('region') or '', step['bot_id'])
+    with limits_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(invocation_bot_limits(step['bot_id'])[1])
+        return rate_limiters[key]
+
+
+def lex_client_for(region: str):
+    """The Lex runtime client for a target's region, the default client when it has none"""
+    if not region or region == os.environ.get('AWS_REGION'):
+        return lex_client
+    with limits_lock:
+        if region not in lex_clients:
+            lex_clients[region] = boto3.client('lexv2-runtime', region_name=region)
+        return lex_clients[region]
+
+
+def cassette_key(test_run: str, test_case: str) -> str:
+    """S3 key of the recorded Lex exchanges for one test_case of one run"""
+    return f'{CASSETTE_PREFIX}/{test_run}/{test_case}.json.gz'
+
+
+def save_cassette(test_run: str, test_case: str, exchanges: list[str]):
+    """Store the recorded (JSON encoded) Lex exchanges of a test_case, gzipped, in the results bucket"""
+    body = gzip.compress(('[' + ','.join(exchanges) + ']').encode('utf-8'))
+    s3_client.put_object(Bucket=RESULTS_BUCKET, Key=cassette_key(test_run, test_case), Body=body, ContentEncoding='gzip')
+
+
+def load_cassette(test_run: str, test_case: str) -> list[dict]:
+    """Load the recorded Lex exchanges of a test_case, empty if nothing was recorded"""
+    try:
+        response = s3_client.get_object(Bucket=RESULTS_BUCKET, Key=cassette_key(test_run, test_case))
+    except Exception as e:
+        logger.error('No cassette for run %s, test_case %s: %s', test_run, test_case, e)
+        return []
+    return json.loads(gzip.decompress(response['Body'].read()))
+
+
+def replay_exchange(cassette: list[dict], index: int, request: dict) -> dict:
+    """Return the recorded response for the index-th Lex call of a test_case, raising what Lex raised when recorded"""
+    if index >= len(cassette):
+        raise LookupError(f'No recorded Lex response for call {index + 1}')
+
+    exchange = cassette[index]
+    if exchange['request'].get('text') != request['text']:
+        logger.warning('Replaying a response recorded for "%s" for utterance "%s"', exchange['request'].get('text'), request['text'])
+    if 'error' in exchange:
+        raise RuntimeError(exchange['error'])
+    return exchange['response']
+
+
+def step_failed(step: dict) -> bool:
+    """A step fails when Lex errored or the codehook graded it anything but a pass.
+    Without a grade, the recognized intent has to match the expected one.
+    """
+    if 'Error' in step:
+        return True
+    if step.get('test_result'):
+        return step['test_result'].lower() not in ('pass', 'passed', 'true')
+    return bool(step.get('expected_intent')) and 'actual_intent' in step and step['actual_intent'] != step['expected_intent']
+
+
 def execute_test_case(test_case: list[dict]) -> list[dict]:
     """Execute a test_case and return the results"""
+    # a run can override the lex mode, and replay another run's cassettes
+    lex_mode = test_case[0].get('lex_mode') or LEX_MODE
+    fail_fast = test_case[0].get('fail_fast', FAIL_FAST)
+    cassette = []
+    if lex_mode == 'replay':
+        # a run never has cassettes of its own, it replays those another run recorded
+        if not test_case[0].get('replay_run'):
+            raise ValueError('replay mode needs the replay_run whose cassettes to replay')
+        cassette = load_cassette(test_case[0]['replay_run'], test_case[0]['test_case'])
+    recording = [] # exchanges are encoded right away, the session dicts are reused by later steps
+    exchanges = 0
+
     attributes = ''
     session_id = None
     request_attributes = {'channel': channel_attribute}
@@ -43,8 +180,8 @@ def execute_test_case(test_case: list[dict]) -> list[dict]:
 
     # loop through each step in the test_case
     # step = row
-    for step in test_case:
-        logger.debug(f'Evaluating Test={step["test_case"]}, Step={step["Step"]}')
+    for index, step in enumerate(test_case):
+        logger.debug(f'Evaluating Test={step["test_case"]}, Step={step["step"]}')
 
         # if the step is a number, it is a test stepsession_attributes
         if int(step['step']) == 1:
@@ -58,7 +195,7 @@ def execute_test_case(test_case: list[dict]) -> list[dict]:
             # parse the session attributes
             if len(attributes) > 0:
                 attributes = attributes.rstrip(',') # remove trailing comma
-                dict(item.split('=') for item in attributes.split(','))
+                session_attributes.update(dict(item.split('=', 1) for item in attributes.split(',')))
 
 
 
@@ -77,75 +214,240 @@ def execute_test_case(test_case: list[dict]) -> list[dict]:
 
         # call Lex
         bot_response = None
+        request = {
+            'botId': step['bot_id'],
+            'botAliasId': step['alias_id'],
+            'localeId': step['locale_id'],
+            'sessionId': session_id,
+            'text': user_input,
+            'sessionState': session_state,
+            'requestAttributes': request_attributes,
+        }
+        start_time = time.perf_counter()
         try:
-            # call Lex
-            bot_response = lex_client.recognize_text(
-                botId=step['bot_id'],
-                botAliasId=step['alias_id'],
-                localeId=step['locale_id'],
-                sessionId=session_id,
-                text=user_input,
-                sessionState=session_state,
-                requestAttributes=request_attributes
-            )
-            logger.debug(f'Bot Response = {json.dumps(bot_response, indent=2)}')
+            if lex_mode == 'replay':
+                bot_response = replay_exchange(cassette, exchanges, request)
+            else:
+                # call Lex, within the bot's rate cap
+                rate_limiter(step).wait()
+                bot_response = lex_client_for(step.get('region')).recognize_text(**request)
         except Exception as e:
+            if lex_mode == 'record':
+                recording.append(json.dumps({'request': request, 'error': str(e)}, default=str))
             step['Error'] = str(e)
-            logger.error('Exception calling lex for test step [{},{}]. Error = {}'.format(step['test_case'], step['Step'], str(e)))
+            logger.error('Exception calling lex for test step [{},{}]. Error = {}'.format(step['test_case'], step['step'], str(e)))
             logger.error(f'Record = {json.dumps(step)}')
 
             break
 
+        step['lex_latency_ms'] = round((time.perf_counter() - start_time) * 1000)
+        if lex_mode == 'record':
+            recording.append(json.dumps({'request': request, 'response': bot_response, 'latency_ms': step['lex_latency_ms']}, default=str))
+        elif lex_mode == 'replay':
+            # report the latency Lex had when the exchange was recorded
+            step['lex_latency_ms'] = cassette[exchanges].get('latency_ms', step['lex_latency_ms'])
+        exchanges += 1
+
         # check if we got a response from Lex
         if bot_response == None:
-            logger.error('No reponse from Lex for test step [{},{}]'.format(step['test_case'], step['Step']))
+            logger.error('No reponse from Lex for test step [{},{}]'.format(step['test_case'], step['step']))
             break
 
-        logger.info("--called Lex for test step [{},{}]".format(step['test_case'], step['Step']))
+        logger.info("--called Lex for test step [{},{}]".format(step['test_case'], step['step']))
 
-        logger.info(json.dumps(bot_response, indent=4))
+        # only serialize the response when it will actually be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Bot Response = {json.dumps(bot_response, indent=2)}')
 
-        step['response'] = bot_response.get('message', [{}])[0].get('content', '[no Response>')
+        step['response'] = (bot_response.get('messages') or [{}])[0].get('content', '[no Response>')
 
         # Update our local state variables
         session_state = bot_response.get('sessionState', {})
         session_attributes = session_state.get('sessionAttributes', {})
+        intent = session_state.get('intent', {})
 
-        step['actual_intent'] = session_attributes.get('actual_intent', '')
-        step['actual_state'] = session_attributes.get('actual_state', '')
+        # the codehook reports its evaluation in session attributes, fall back to what Lex recognized
+        step['actual_intent'] = session_attributes.get('actual_intent', intent.get('name', ''))
+        step['actual_state'] = session_attributes.get('actual_state', intent.get('state', ''))
         step['test_result'] = session_attributes.get('test_result', '')
         step['test_explanation'] = session_attributes.get('test_explanation', '')
 
 
-        logger.debug(f'Session: {session_id}: Answer test step: [{step["test_case"]}.{step["Step"]} is {step["Response"]}')
+        logger.debug(f'Session: {session_id}: Answer test step: [{step["test_case"]}.{step["step"]} is {step["response"]}')
+
+        if fail_fast and step_failed(step):
+            logger.info('Test step [{},{}] failed, skipping the rest of the conversation'.format(step['test_case'], step['step']))
+            for skipped in test_case[index + 1:]:
+                skipped['test_result'] = 'Skipped'
+                skipped['test_explanation'] = f'Step {step["step"]} failed'
+            break
+
+    if lex_mode == 'record':
+        save_cassette(test_case[0].get('test_run', test_run_id), test_case[0]['test_case'], recording)
 
     return test_case
 
+def parse_message(body: str) -> list[list[dict]]:
+    """Parse an SQS message body into a list of test_cases.
+    The initializer packs several test_cases per message; a bare list of steps is a single test_case.
+    """
+    payload = json.loads(body)
+    if payload and isinstance(payload[0], dict):
+        return [payload]
+    return payload
+
 # process a list of test_cases
 def process_test_cases(test_cases: list[list[dict]]):
-    test_results: list[list[dict]] = []
+    """Run the test_cases, each bot's cases by its own workers (as many as its concurrency cap),
+    so the bots of a target matrix are tested side by side. Results keep the order of test_cases.
+    """
+    test_results: list[list[dict]] = [None] * len(test_cases)
     start_time = time.perf_counter()
-    for test_case in test_cases:
-        test_results.append(execute_test_case(test_case))
+
+    queues = defaultdict(deque) # indexes of the test_cases for each (region, bot_id)
+    for index, test_case in enumerate(test_cases):
+        queues[(test_case[0].get('region') or '', test_case[0]['bot_id'])].append(index)
+
+    def work(queue: deque):
+        while True:
+            try:
+                index = queue.popleft()
+            except IndexError:
+                return
+            test_results[index] = execute_test_case(test_cases[index])
+
+    workers = [queue for (_, bot_id), queue in queues.items() for _ in range(min(invocation_bot_limits(bot_id)[0], len(queue)))]
+    if len(workers) == 1:
+        work(workers[0])
+    elif workers:
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            for future in [executor.submit(work, queue) for queue in workers]:
+                future.result()
+
     duration = time.perf_counter() - start_time
     return duration, test_results
 
+def send_results(test_results: list[list[dict]]):
+    """Send every executed step to Firehose as a JSON line"""
+    records = [{'Data': json.dumps(step) + '\n'} for test_case in test_results for step in test_case]
+    for i in range(0, len(records), FIREHOSE_BATCH_SIZE):
+        response = firehose_client.put_record_batch(DeliveryStreamName=FIREHOSE_NAME, Records=records[i:i + FIREHOSE_BATCH_SIZE])
+        if response.get('FailedPutCount'):
+            logger.error('Firehose rejected %d records', response['FailedPutCount'])
+
+def index_entry(step: dict) -> list:
+    """Compact summary of a step result: [result hash, actual_intent, test_result, failed, lex_latency_ms]"""
+    outcome = [step.get(key, '') for key in ('response', 'actual_intent', 'actual_state', 'test_result', 'Error')]
+    digest = hashlib.sha1(json.dumps(outcome).encode('utf-8')).hexdigest()[:12]
+    return [digest, step.get('actual_intent', ''), step.get('test_result', ''), int(step_failed(step)), step.get('lex_latency_ms')]
+
+
+def write_index(test_results: list[list[dict]]):
+    """Write one index part per run for the test_cases processed in this invocation.
+    The parts of a run are merged into a single index the first time the run is diffed.
+    """
+    runs = {}
+    for test_case in test_results:
+        for step in test_case:
+            entries = runs.setdefault(step.get('test_run', test_run_id), {})
+            entries.setdefault(step['test_case'], {})[step['step']] = index_entry(step)
+
+    for test_run, entries in runs.items():
+        key = f'{INDEX_PREFIX}/{test_run}/parts/{uuid.uuid4().hex}.json.gz'
+        try:
+            s3_client.put_object(Bucket=RESULTS_BUCKET, Key=key, Body=gzip.compress(json.dumps(entries).encode('utf-8')))
+        except Exception as e:
+            # the results are already in Firehose, don't redo the Lex calls over the index
+            logger.error('Could not write index part %s: %s', key, e)
+
+
+def queue_url(record: dict) -> str:
+    """The queue a record came from: the test queue or one of the bot lanes"""
+    # direct invocations have no event source
+    arn = record.get('eventSourceARN', '').split(':')
+    if len(arn) != 6 or arn[2] != 'sqs':
+        return QUEUE_URL
+    _, _, _, region, account, name = arn
+    return f'https://sqs.{region}.amazonaws.com/{account}/{name}'
+
+
+def dead_letter(record: dict, error: Exception):
+    """Move a message that failed its last allowed receive to the dead-letter queue, recording why it failed"""
+    reason = (str(error) or type(error).__name__)[:MAX_FAILURE_REASON_LENGTH]
+    sqs_client.send_message(
+        QueueUrl=DLQ_URL,
+        MessageBody=record['body'],
+        MessageAttributes={
+            'failure_type': {'DataType': 'String', 'StringValue': type(error).__name__},
+            'failure_reason': {'DataType': 'String', 'StringValue': reason},
+            'receive_count': {'DataType': 'Number', 'StringValue': record['attributes']['ApproximateReceiveCount']},
+            'source_message_id': {'DataType': 'String', 'StringValue': record['messageId']},
+            # the redrive sends it back to its own lane
+            'source_queue': {'DataType': 'String', 'StringValue': queue_url(record)},
+        },
+    )
+    sqs_client.delete_message(QueueUrl=queue_url(record), ReceiptHandle=record['receiptHandle'])
+    logger.error('Moved message %s to the dead-letter queue: %s: %s', record['messageId'], type(error).__name__, reason)
+
+
 # main handler
 def handler(event, context):
-    print('Received event: %s', json.dumps(event))
+    """
+    Expects an SQS event. The initializer's smoke tests and the state machine invoke it directly,
+    with records that only have a body (and messageId), so there is nothing to delete.
+    Optional keys:
+    'summary': Return the number of test_cases, steps and failed steps instead of the results
+    A warm-up invocation from the initializer ({'warmup': true, 'hold_ms': ...}) only initializes the container.
+    """
+    if event.get('warmup'):
+        # the clients are created at import, so the container is ready. Stay busy for a moment so
+        # the other warm-up invocations of the batch start containers of their own
+        time.sleep(event.get('hold_ms', 0) / 1000)
+        return {'warm': True}
+
+    logger.debug('Received event: %s', json.dumps(event))
 
-    # Parse SQS message
-    test_cases = [json.loads(record['body']) for record in event['Records']]
-    logger.info('Received %d test_cases', len(test_cases))
+    # Process each SQS message on its own, so a malformed one doesn't fail the others
+    test_results, processed, failed = [], [], []
+    start_time = time.perf_counter()
+    for record in event['Records']:
+        try:
+            test_cases = parse_message(record['body'])
+            logger.info('Received %d test_cases', len(test_cases))
+            _, results = process_test_cases(test_cases)
+        except Exception as e:
+            logger.exception('Message %s failed', record.get('messageId'))
+            failed.append((record, e))
+            continue
+        test_results.extend(results)
+        processed.append(record)
+    logger.info(f'Duration = {time.perf_counter() - start_time:.0f} seconds')
 
-    # Process test_cases
-    duration, test_results = process_test_cases(test_cases)
-    logger.info(f'Duration = {duration:.0f} seconds')
+    # Send results to Firehose
+    send_results(test_results)
+    write_index(test_results)
 
     # Remove processed messages from SQS
-    for record in event['Records']:
-        sqs_client.delete_message(QUEUE_URL, ReceiptHandle=record['receiptHandle'])
+    for record in processed:
+        # direct invocations (smoke tests) don't come from the queue
+        if 'receiptHandle' in record:
+            sqs_client.delete_message(QueueUrl=queue_url(record), ReceiptHandle=record['receiptHandle'])
+
+    # Failed messages are retried, until their last allowed receive sends them to the dead-letter queue
+    retried = []
+    for record, error in failed:
+        receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+        if DLQ_URL and 'receiptHandle' in record and receive_count >= MAX_RECEIVE_COUNT:
+            dead_letter(record, error)
+        else:
+            retried.append(f'{record.get("messageId")}: {type(error).__name__}: {error}')
+    flush_logs()
+    if retried:
+        raise RuntimeError(f'{len(retried)} of {len(event["Records"])} messages failed: ' + '; '.join(retried))
 
     logger.info('Processing complete')
-    flush_logs()
+    if event.get('summary'):
+        # the state machine only needs counts, and its states are limited to 256 KiB
+        steps = [step for test_case in test_results for step in test_case]
+        return {'test_cases': len(test_results), 'steps': len(steps), 'failed_steps': sum(step_failed(step) for step in steps)}
     return test_results
@@ -0,0 +1,140 @@
+# redrive.py
+"""
+This lambda function moves messages from the test queue's dead-letter queue back to the queue they
+came from (the test queue or a bot's lane), at a controlled rate, once whatever made them fail has
+been fixed. It can be limited to some failure types, and a dry run only reports why the dead-lettered
+messages failed.
+
+It can also be run locally with AWS credentials:
+    python -m lambdas.redrive.index --queue-url <test queue> --dlq-url <dead-letter queue> --messages-per-second 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections import Counter
+import boto3
+
+# Configure logging
+logging.basicConfig(level=os.environ.get('LOGGING_LEVEL', 'DEBUG'))
+logger = logging.getLogger(__name__) # __name__ is the name of the module
+
+# Initialize AWS clients
+sqs_client = boto3.client('sqs')
+
+# Environment variables
+QUEUE_URL = os.getenv('QUEUE_URL')
+DLQ_URL = os.getenv('DLQ_URL')
+REDRIVE_RATE = float(os.getenv('REDRIVE_RATE', '5')) # messages per second sent back to the test queue
+
+# messages looked at but not redriven stay hidden from this invocation for this long, then are released
+VISIBILITY_SECONDS = 900
+# stop receiving when the invocation has less time left than this
+MIN_REMAINING_MS = 10000
+# distinct failure reasons included in the report
+MAX_REASONS = 20
+
+# the processor only records a reason when it saw the failure, not when it timed out or crashed
+UNKNOWN_FAILURE = 'Unknown'
+
+
+def failure(message: dict) -> tuple[str, str]:
+    """(failure_type, failure_reason) recorded with a dead-lettered message"""
+    attributes = message.get('MessageAttributes', {})
+    failure_type = attributes.get('failure_type', {}).get('StringValue', UNKNOWN_FAILURE)
+    reason = attributes.get('failure_reason', {}).get('StringValue', 'No reason recorded, the processor timed out or crashed')
+    return failure_type, reason
+
+
+def receive(max_messages: int) -> list[dict]:
+    response = sqs_client.receive_message(
+        QueueUrl=DLQ_URL,
+        MaxNumberOfMessages=max(1, min(10, max_messages)),
+        MessageAttributeNames=['All'],
+        VisibilityTimeout=VISIBILITY_SECONDS,
+        WaitTimeSeconds=1,
+    )
+    return response.get('Messages', [])
+
+
+def handler(event, context):
+    """
+    Optional keys:
+    'messages_per_second': Rate at which messages are sent back to the test queue. Default REDRIVE_RATE
+    'max_messages': Stop after this many messages were redriven
+    'failure_types': Only redrive messages that failed with one of these, e.g. ["KeyError", "Unknown"]
+    'dry_run': Only report the failures of the dead-lettered messages
+    """
+
+    logger.debug('Event Received: %s', event)
+
+    interval = 1 / float(event.get('messages_per_second', REDRIVE_RATE))
+    max_messages = event.get('max_messages')
+    failure_types = set(event.get('failure_types', []))
+    dry_run = event.get('dry_run', False)
+
+    redriven, held = 0, [] # held: receipt handles of messages looked at but left in the dead-letter queue
+    failures, reasons = Counter(), {}
+    next_send = time.monotonic()
+    while max_messages is None or redriven < max_messages:
+        if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_MS:
+            logger.warning('Running out of time, stopping the redrive')
+            break
+        messages = receive(10 if max_messages is None else max_messages - redriven)
+        if not messages:
+            break
+
+        for message in messages:
+            failure_type, reason = failure(message)
+            failures[failure_type] += 1
+            if len(reasons) < MAX_REASONS:
+                reasons.setdefault(reason, failure_type)
+
+            if dry_run or (failure_types and failure_type not in failure_types):
+                held.append(message['ReceiptHandle'])
+                continue
+
+            # spread the messages out so the processors and the bots aren't flooded
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_send = max(next_send, time.monotonic()) + interval
+
+            # back to the queue it came from, a bot's lane or the test queue
+            source_queue = message.get('MessageAttributes', {}).get('source_queue', {}).get('StringValue', QUEUE_URL)
+            sqs_client.send_message(QueueUrl=source_queue, MessageBody=message['Body'])
+            sqs_client.delete_message(QueueUrl=DLQ_URL, ReceiptHandle=message['ReceiptHandle'])
+            redriven += 1
+
+    # make the messages left behind visible again for the next redrive
+    for receipt_handle in held:
+        sqs_client.change_message_visibility(QueueUrl=DLQ_URL, ReceiptHandle=receipt_handle, VisibilityTimeout=0)
+
+    logger.info('Redrove %d messages, left %d in the dead-letter queue. Failures: %s', redriven, len(held), dict(failures))
+
+    return {
+        'statusCode': 200,
+        'redriven': redriven,
+        'held': len(held),
+        'failures': dict(failures),
+        'reasons': [{'failure_type': failure_type, 'failure_reason': reason} for reason, failure_type in reasons.items()],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move dead-lettered test messages back to the test queue')
+    parser.add_argument('--queue-url', default=QUEUE_URL, help='test queue')
+    parser.add_argument('--dlq-url', default=DLQ_URL, help='dead-letter queue of the test queue')
+    parser.add_argument('--messages-per-second', type=float, default=REDRIVE_RATE)
+    parser.add_argument('--max-messages', type=int)
+    parser.add_argument('--failure-type', dest='failure_types', action='append', default=[], help='only redrive these failures')
+    parser.add_argument('--dry-run', action='store_true', help='only report why the messages failed')
+    args = parser.parse_args()
+
+    QUEUE_URL, DLQ_URL = args.queue_url, args.dlq_url
+    event = {'messages_per_second': args.messages_per_second, 'failure_types': args.failure_types, 'dry_run': args.dry_run}
+    if args.max_messages is not None:
+        event['max_messages'] = args.max_messages
+    print(json.dumps(handler(event, None), indent=2))
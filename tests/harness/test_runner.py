@@ -0,0 +1,395 @@
+import gzip
+import json
+import time
+import pytest
+from unittest.mock import patch
+
+from harness.benchmark import COLUMNS, synthetic_csv
+from harness.fakes import FakeLex, constant_latency
+from harness.runner import DLQ_URL, LocalPipeline, QUEUE_URL, RunStats, lane_url, percentile
+
+
+@pytest.fixture
+def suite():
+    """Fixture providing a small synthetic suite"""
+    return synthetic_csv(25, max_steps=4, seed=1)
+
+def test_pipeline_runs_every_case(suite):
+    """Test that every case of the suite ends up in Firehose and the queue is drained"""
+
+    with LocalPipeline(concurrency=4) as pipeline:
+        stats = pipeline.run(suite)
+
+    assert stats.cases == 25
+    assert stats.steps == len(suite.splitlines()) - 1
+    assert stats.steps == pipeline.lex.calls
+    assert stats.invocations == stats.messages
+    assert pipeline.sqs.depth(QUEUE_URL) == 0
+    assert not pipeline.sqs.in_flight
+    results = [json.loads(record) for record in pipeline.firehose.records]
+    assert all(step['test_result'] == 'Pass' for step in results)
+
+def test_pipeline_failure_injection_ends_conversations(suite):
+    """Test that a failing Lex call is recorded and the rest of the conversation is skipped"""
+
+    with LocalPipeline(lex=FakeLex(failure_rate=1.0)) as pipeline:
+        stats = pipeline.run(suite)
+
+    assert stats.cases == 25
+    assert pipeline.lex.calls == 25
+    results = [json.loads(record) for record in pipeline.firehose.records]
+    errors = [step for step in results if 'Error' in step]
+    assert len(errors) == 25
+    assert all(step['step'] == '1' and 'InternalFailureException' in step['Error'] for step in errors)
+
+def test_fake_lex_throttles_beyond_max_concurrency(suite):
+    """Test that calls beyond the concurrency cap are throttled"""
+
+    lex = FakeLex(latency=constant_latency(0.01), max_concurrency=1)
+    with LocalPipeline(lex=lex, concurrency=4) as pipeline:
+        pipeline.run(suite)
+
+    assert lex.throttled > 0
+
+def test_bot_lane_caps_the_bot_across_invocations(suite):
+    """Test that a bot's lane keeps it under its cap however many processors run"""
+
+    lex = FakeLex(latency=constant_latency(0.01), max_concurrency=1)
+    with LocalPipeline(lex=lex, concurrency=4, lanes={'BENCHMARKBOT': 1}) as pipeline:
+        stats = pipeline.run(suite)
+
+    assert lex.throttled == 0
+    assert stats.cases == 25
+    assert pipeline.sqs.depth(QUEUE_URL) == 0
+    assert not pipeline.sqs.in_flight
+
+def test_percentile():
+    """Test nearest-rank percentiles"""
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 99) == 0.0
+
+def test_pipeline_replays_recorded_run(suite):
+    """Test that a recorded run can be replayed offline with the same results"""
+
+    with LocalPipeline() as pipeline:
+        pipeline.run(suite, lex_mode='record')
+        recorded = [json.loads(record) for record in pipeline.firehose.records]
+        pipeline.firehose.records.clear()
+        pipeline.lex.failure_rate = 1.0 # any call to Lex would now fail
+        calls = pipeline.lex.calls
+
+        pipeline.run(suite, lex_mode='replay', replay_run=recorded[0]['test_run'])
+        replayed = [json.loads(record) for record in pipeline.firehose.records]
+
+    assert pipeline.lex.calls == calls
+
+    def key(step):
+        return int(step['test_case']), int(step['step'])
+
+    assert [step['response'] for step in sorted(replayed, key=key)] == [step['response'] for step in sorted(recorded, key=key)]
+
+def test_replay_without_replay_run_is_refused(suite):
+    """Test that a replay run has to name the run it replays"""
+
+    with LocalPipeline() as pipeline:
+        with pytest.raises(ValueError, match='replay_run'):
+            pipeline.run(suite, lex_mode='replay')
+
+    assert pipeline.sqs.sent == 0
+
+def test_pipeline_smoke_failure_stops_run(suite):
+    """Test that a failing smoke subset stops the run before anything is queued"""
+
+    lex = FakeLex(intent_for=lambda kwargs: 'FallbackIntent')
+    with LocalPipeline(lex=lex) as pipeline:
+        stats = pipeline.run(suite, smoke_cases=5, smoke_max_failure_rate=0.2)
+
+    assert stats.initializer_result['smoke_failures'] == 5
+    assert stats.messages == 0
+    assert stats.cases == 5
+
+def test_pipeline_passing_smoke_runs_the_rest(suite):
+    """Test that a passing smoke subset is followed by the rest of the suite, each case once"""
+
+    with LocalPipeline() as pipeline:
+        stats = pipeline.run(suite, smoke_cases=5)
+
+    assert stats.initializer_result['Message'] == 'Processing complete'
+    assert stats.cases == 25
+    assert stats.steps == len(suite.splitlines()) - 1
+
+def test_pipeline_runs_only_selected_intents(suite):
+    """Test that only test cases expecting a selected intent are run"""
+
+    with LocalPipeline() as pipeline:
+        pipeline.run(suite, intents=['GoodbyeIntent'])
+        results = [json.loads(record) for record in pipeline.firehose.records]
+
+    selected = {row.split(',')[0] for row in suite.splitlines()[1:] if ',GoodbyeIntent,' in row}
+    assert selected
+    assert {step['test_case'] for step in results} == selected
+
+def test_duplicate_event_is_ignored(suite):
+    """Test that a redelivered Object Created event doesn't queue the suite again"""
+
+    with LocalPipeline() as pipeline:
+        s3_path = pipeline.upload(suite)
+        bucket, key = s3_path[5:].split('/', 1)
+        version = pipeline.s3.objects[(bucket, key)]
+        event = {'detail': {
+            'bucket': {'name': bucket},
+            'object': {'key': key, 'etag': version['ETag'].strip('"'), 'version-id': version['VersionId']},
+        }}
+
+        first = pipeline.initializer.handler(event, None)
+        queued = pipeline.sqs.sent
+        second = pipeline.initializer.handler(event, None)
+
+    assert first['Message'] == 'Processing complete'
+    assert second['Message'] == 'Duplicate run ignored'
+    assert second['run_key'] == first['run_key']
+    assert pipeline.sqs.sent == queued
+
+def _interrupt_sending_after(pipeline: LocalPipeline, batches: int, error: BaseException):
+    """Make the initializer's batch sends fail with error once, after this many batches"""
+    send = pipeline.sqs.send_message_batch
+    calls = []
+
+    def send_message_batch(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == batches + 1:
+            raise error
+        return send(**kwargs)
+    return patch.object(pipeline.sqs, 'send_message_batch', side_effect=send_message_batch)
+
+def test_failed_run_is_resumed_by_its_retry():
+    """Test that retrying a run that failed partway only sends the messages it hadn't recorded as sent"""
+    suite = synthetic_csv(200, seed=1)
+
+    with LocalPipeline(environment={'CHECKPOINT_MESSAGES': 10}) as pipeline:
+        event = {'s3_path': pipeline.upload(suite)}
+        with _interrupt_sending_after(pipeline, 3, RuntimeError('SQS unavailable')):
+            with pytest.raises(RuntimeError):
+                pipeline.initializer.handler(event, None)
+        assert pipeline.sqs.sent == 30
+        retry = pipeline.initializer.handler(event, None)
+        stats = RunStats()
+        pipeline.drain(stats)
+        steps = [json.loads(record) for record in pipeline.firehose.records]
+
+    assert retry['resumed_from'] == 30
+    assert pipeline.sqs.sent == retry['messages'] > 30
+    assert len(steps) == len(suite.splitlines()) - 1
+    assert len({step['test_case'] for step in steps}) == 200
+    assert len({step['test_run'] for step in steps}) == 1
+
+def test_timed_out_run_is_resumed_once_past_its_deadline(suite):
+    """Test that a run whose invocation was killed is a duplicate while it could still be running, then resumed"""
+
+    with LocalPipeline(environment={'CHECKPOINT_MESSAGES': 1}) as pipeline:
+        event = {'s3_path': pipeline.upload(suite)}
+        # killed, without the chance to record that it stopped
+        with _interrupt_sending_after(pipeline, 2, KeyboardInterrupt()):
+            with pytest.raises(KeyboardInterrupt):
+                pipeline.initializer.handler(event, None)
+        duplicate = pipeline.initializer.handler(event, None)
+        # a retry once the first invocation would have timed out
+        with patch('time.time', return_value=time.time() + pipeline.initializer.INITIALIZER_TIMEOUT_SECONDS + 1):
+            retry = pipeline.initializer.handler(event, None)
+        again = pipeline.initializer.handler(event, None)
+
+    assert duplicate['Message'] == 'Duplicate run ignored'
+    assert duplicate['status'] == 'started'
+    assert retry['Message'] == 'Processing complete'
+    assert retry['resumed_from'] == 2
+    assert pipeline.sqs.sent == retry['messages']
+    assert again['Message'] == 'Duplicate run ignored'
+    assert again['status'] == 'completed'
+
+def test_delta_rerun_queues_only_changed_cases(suite):
+    """Test that a delta rerun only runs test cases that are new or changed"""
+
+    rows = suite.splitlines()
+    changed = [rows[0]] + [row.replace('utterance 3.', 'changed utterance 3.') for row in rows[1:]]
+    changed.append('26,1,a new case,,,GreetingIntent,Fulfilled,BENCHMARKBOT,TSTALIASID,en_US')
+
+    with LocalPipeline() as pipeline:
+        pipeline.run(suite, track_changes=True)
+        stats = pipeline.run('\n'.join(changed) + '\n', delta=True)
+
+    assert stats.cases == 2
+
+def test_untracked_run_keeps_no_hashes(suite):
+    """Test that a run without delta or track_changes doesn't record its test cases"""
+
+    with LocalPipeline() as pipeline:
+        pipeline.run(suite)
+        keys = [key for _, key in pipeline.s3.objects]
+
+    assert not [key for key in keys if '/suites/' in key]
+
+def test_diff_local_runs(suite):
+    """Test that the differ reports the steps that started failing between two runs"""
+
+    with LocalPipeline() as pipeline:
+        base = pipeline.run(suite)
+        pipeline.lex.intent_for = lambda kwargs: 'FallbackIntent' if kwargs['text'].startswith('utterance 1.') else kwargs['sessionState']['sessionAttributes']['expected-intent']
+        run = pipeline.run(suite)
+        report = pipeline.differ.handler({'base_run': base.test_run, 'run': run.test_run}, None)
+
+    steps = sum(1 for row in suite.splitlines()[1:] if row.startswith('1,'))
+    assert report['summary']['new_failures'] == steps
+    assert {failure['test_case'] for failure in report['new_failures']} == {'1'}
+    assert report['summary']['fixes'] == 0
+
+
+def test_pipeline_runs_manifest_of_suites(suite):
+    """Test that a manifest runs every listed suite, compressed or not, as one run"""
+
+    with LocalPipeline() as pipeline:
+        pipeline.upload(gzip.compress(suite.encode('utf-8')), 'a.csv.gz')
+        pipeline.upload(suite, 'b.csv')
+        manifest = {'suites': ['lex-analytics/input/a.csv.gz', 's3://lex-analytics-test-tool-bucket/lex-analytics/input/b.csv']}
+        stats = pipeline.run(json.dumps(manifest), name='nightly.manifest.json')
+
+    assert stats.cases == 50
+    assert stats.steps == 2 * (len(suite.splitlines()) - 1)
+
+def test_pipeline_runs_unsorted_suite(suite):
+    """Test that a suite whose test case rows are not together still runs every conversation whole"""
+    header, *rows = suite.splitlines()
+    unsorted = '\n'.join([header] + rows[1::2] + rows[::2]) + '\n'
+
+    with LocalPipeline() as pipeline:
+        stats = pipeline.run(unsorted, orchestration='stepfunctions')
+        result = stats.initializer_result
+        batches = pipeline.s3.get_object(Bucket=result['batches_bucket'], Key=result['batches_key'])['Body'].read().decode('utf-8')
+
+    test_cases = [test_case for line in batches.splitlines() for test_case in json.loads(json.loads(line)['body'])]
+    assert len(test_cases) == stats.cases == 25
+    assert sum(len(test_case) for test_case in test_cases) == stats.steps == len(rows)
+
+def test_manifest_reruns_when_a_listed_suite_changes(suite):
+    """Test that re-invoking a manifest is a duplicate until one of the suites it lists changes"""
+
+    with LocalPipeline() as pipeline:
+        pipeline.upload(suite, 'a.csv')
+        manifest = pipeline.upload(json.dumps({'suites': ['lex-analytics/input/a.csv']}), 'nightly.manifest.json')
+        first = pipeline.initializer.handler({'s3_path': manifest}, None)
+        duplicate = pipeline.initializer.handler({'s3_path': manifest}, None)
+        pipeline.upload(suite + '26,1,one more,,,GreetingIntent,Fulfilled,BENCHMARKBOT,TSTALIASID,en_US\n', 'a.csv')
+        changed = pipeline.initializer.handler({'s3_path': manifest}, None)
+
+    assert first['Message'] == 'Processing complete'
+    assert duplicate['Message'] == 'Duplicate run ignored'
+    assert changed['Message'] == 'Processing complete'
+    assert changed['run_key'] != first['run_key']
+
+
+def test_pipeline_runs_target_matrix(suite):
+    """Test that a target matrix runs every case once per target, labelled with its target"""
+
+    with LocalPipeline(concurrency=2) as pipeline:
+        stats = pipeline.run(suite, targets=[{'alias_id': 'PROD'}, {'alias_id': 'TEST', 'locale_id': 'en_GB'}])
+        steps = [json.loads(record) for record in pipeline.firehose.records]
+
+    assert stats.cases == 50
+    assert {step['target'] for step in steps} == {'PROD', 'TEST/en_GB'}
+    assert all(step['test_result'] == 'Pass' for step in steps)
+
+
+def test_failing_messages_are_dead_lettered_then_redriven(suite):
+    """Test that messages failing every receive end up in the dead-letter queue, and run once redriven after a fix"""
+
+    with LocalPipeline(max_receives=2) as pipeline:
+        with patch.object(pipeline.processor, 'process_test_cases', side_effect=KeyError('Step')):
+            stats = pipeline.run(suite)
+
+        assert stats.cases == 0
+        assert stats.dead_letters == stats.messages
+        report = pipeline.redrive.handler({'dry_run': True}, None)
+        assert report['redriven'] == 0
+        assert report['failures'] == {'KeyError': stats.messages}
+        assert pipeline.sqs.depth(DLQ_URL) == stats.messages
+
+        report = pipeline.redrive.handler({'messages_per_second': 1000}, None)
+        pipeline.drain(RunStats())
+
+    assert report['redriven'] == stats.messages
+    assert pipeline.sqs.depth(DLQ_URL) == 0
+    assert len({json.loads(record)['test_case'] for record in pipeline.firehose.records}) == 25
+
+def test_lane_messages_are_redriven_to_their_lane(suite):
+    """Test that dead-lettered messages from a bot's lane go back to that lane"""
+
+    with LocalPipeline(max_receives=1, lanes={'BENCHMARKBOT': 2}) as pipeline:
+        with patch.object(pipeline.processor, 'process_test_cases', side_effect=KeyError('Step')):
+            stats = pipeline.run(suite)
+
+        assert stats.dead_letters == stats.messages
+        pipeline.redrive.handler({'messages_per_second': 1000}, None)
+
+        assert pipeline.sqs.depth(QUEUE_URL) == 0
+        assert pipeline.sqs.depth(lane_url('BENCHMARKBOT')) == stats.messages
+
+
+def test_pipeline_stepfunctions_orchestration(suite):
+    """Test that a run orchestrated by the state machine runs every case without going through the queue"""
+
+    with LocalPipeline(concurrency=4) as pipeline:
+        stats = pipeline.run(suite, orchestration='stepfunctions')
+
+    assert stats.cases == 25
+    assert stats.invocations == stats.messages == stats.initializer_result['messages']
+    assert pipeline.sqs.sent == 0
+
+
+def test_stepfunctions_batches_are_uploaded_in_parts(suite):
+    """Test that batches larger than a part are streamed to S3 as a multipart upload"""
+
+    with LocalPipeline(concurrency=4, environment={'BATCHES_PART_BYTES': 1024}) as pipeline:
+        stats = pipeline.run(suite, orchestration='stepfunctions')
+
+    assert pipeline.s3.parts_uploaded > 1
+    assert not pipeline.s3.uploads
+    assert stats.cases == 25
+    assert stats.invocations == stats.messages == stats.initializer_result['messages']
+
+
+def test_pipeline_prewarms_processor(suite):
+    """Test that the processor is warmed up before the run is queued, and warm-ups run no test cases"""
+
+    with LocalPipeline() as pipeline:
+        stats = pipeline.run(suite, prewarm_cases_per_second=1000)
+
+    assert stats.initializer_result['prewarmed'] > 1
+    assert pipeline.lambda_.invocations == stats.initializer_result['prewarmed']
+    assert stats.cases == 25
+    assert stats.steps == pipeline.lex.calls
+
+
+def test_prewarm_counts_expanded_templates():
+    """Test that a template is pre-warmed for the cases it expands to, not as a single case"""
+    suite = ','.join(COLUMNS) + '\n1,1,a flight to {city},,,BookFlight,Fulfilled,BENCHMARKBOT,TSTALIASID,en_US\n'
+
+    with LocalPipeline() as pipeline:
+        stats = pipeline.run(suite, prewarm_cases_per_second=1000, template_values={'city': [f'city {i}' for i in range(64)]})
+
+    assert stats.cases == 64
+    # 64 one-second cases fill 8 messages of 8 seconds
+    assert stats.initializer_result['prewarmed'] == 8
+
+
+def test_prewarm_counts_only_what_a_delta_rerun_queues(suite):
+    """Test that a delta rerun with nothing changed warms nothing up"""
+
+    with LocalPipeline() as pipeline:
+        pipeline.run(suite, track_changes=True)
+        stats = pipeline.run(suite, delta=True, prewarm_cases_per_second=1000)
+
+    assert stats.cases == 0
+    assert stats.initializer_result['prewarmed'] == 0
+    assert pipeline.lambda_.invocations == 0
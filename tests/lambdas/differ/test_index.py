@@ -0,0 +1,37 @@
+import pytest
+
+from lambdas.differ.index import diff_indexes
+
+
+@pytest.fixture
+def base_index():
+    """Fixture providing the index of a base run"""
+    return {
+        '1': {'1': ['aaa', 'GreetingIntent', 'Pass', 0, 200], '2': ['bbb', 'OrderIntent', 'Pass', 0, 300]},
+        '2': {'1': ['ccc', 'FallbackIntent', 'Fail', 1, 250]},
+        '3': {'1': ['ddd', 'GoodbyeIntent', 'Pass', 0, 100]},
+    }
+
+def test_diff_indexes(base_index):
+    """Test that new failures, fixes, intent drift and latency regressions are reported"""
+    run_index = {
+        '1': {'1': ['aaa', 'GreetingIntent', 'Pass', 0, 1200], '2': ['eee', 'FallbackIntent', 'Fail', 1, 300]},
+        '2': {'1': ['fff', 'TransferIntent', 'Pass', 0, 250]},
+        '4': {'1': ['ggg', 'GoodbyeIntent', 'Pass', 0, 100]},
+    }
+
+    report = diff_indexes(base_index, run_index, latency_threshold_ms=500)
+
+    assert report['new_failures'] == [{'test_case': '1', 'step': '2', 'test_result': 'Fail', 'base_test_result': 'Pass'}]
+    assert report['fixes'] == [{'test_case': '2', 'step': '1', 'test_result': 'Pass', 'base_test_result': 'Fail'}]
+    assert [(d['test_case'], d['actual_intent']) for d in report['intent_drift']] == [('1', 'FallbackIntent'), ('2', 'TransferIntent')]
+    assert report['latency_regressions'] == [{'test_case': '1', 'step': '1', 'lex_latency_ms': 1200, 'base_lex_latency_ms': 200}]
+    assert report['added'] == [{'test_case': '4', 'step': '1'}]
+    assert report['removed'] == [{'test_case': '3', 'step': '1'}]
+    assert report['summary']['new_failures'] == 1
+
+def test_diff_identical_runs_is_empty(base_index):
+    """Test that a run compared with itself reports nothing"""
+    report = diff_indexes(base_index, base_index)
+
+    assert all(count == 0 for count in report['summary'].values())
@@ -1,11 +1,13 @@
 
 import os
-import io
+import gzip
+from io import BytesIO
+import math
 import json
 from unittest.mock import patch
 import pytest
 
-from lambdas.initializer.index import handler
+from lambdas.initializer.index import handler, pack_test_cases, estimate_test_case_seconds, within_timeout, expand_template, pairwise_combinations, send_messages, write_batches, changed_intents, read_rows, expand_targets, prewarm_concurrency, prewarm_ahead, is_sorted, group_test_cases
 
 os.environ['QUEUE_URL'] = 'https://sqs.us-east-1.amazonaws.com/123456789012/fake-queue-url'
 
@@ -14,9 +16,10 @@ os.environ['QUEUE_URL'] = 'https://sqs.us-east-1.amazonaws.com/123456789012/fake
 def csv_content():
 
     """Fixture to read the CSV file content"""
-    csv_file_path = os.path.join(os.path.dirname(__file__), "../../../../docs/2025-06-10-pamphlet_bot.csv")
+    csv_file_path = os.path.join(os.path.dirname(__file__), "../../../docs/2025-06-10-pamphlet_bot.csv")
     with open(csv_file_path, 'r') as f:
         csv_content = f.read()
+    return csv_content
 
 @pytest.fixture
 def s3_event():
@@ -30,14 +33,16 @@ def mock_s3_response(csv_content):
 
 @pytest.fixture
 def mock_sqs_response():
-    """Fixture providing a mock SQS send_message response"""
-    return {'MessageId': '1234567890'}
+    """Fixture providing a mock SQS send_message_batch response"""
+    return {'Successful': [{'Id': '0', 'MessageId': '1234567890'}], 'Failed': []}
 
-@patch('lambdas.initializer.index.sqs_client')
-@patch('lambdas.initializer.index.s3_client')
+@patch('lambdas.initializer.index.s3_client.put_object')
+@patch('lambdas.initializer.index.sqs_client.send_message_batch')
+@patch('lambdas.initializer.index.s3_client.get_object')
 def test_handler_s3_get_object_called_correctly(
-    mock_send_message,
     mock_get_object,
+    mock_send_message,
+    mock_put_object,
     s3_event,
     mock_s3_response,
     mock_sqs_response):
@@ -48,12 +53,13 @@ def test_handler_s3_get_object_called_correctly(
 
     handler(s3_event, None)
 
-    # Verify S3 get_object was called
-    mock_get_object.assert_called_once()
+    # Verify S3 get_object was called for the suite
+    assert mock_get_object.call_args_list[0].kwargs == {'Bucket': 'test-bucket', 'Key': 'test-file.csv'}
 
+@patch('lambdas.initializer.index.s3_client.put_object')
 @patch('lambdas.initializer.index.s3_client.get_object')
-@patch('lambdas.initializer.index.sqs_client.send_message')
-def test_handler_sqs_message_content(mock_send_message, mock_get_object, s3_event, mock_s3_response, mock_sqs_response):
+@patch('lambdas.initializer.index.sqs_client.send_message_batch')
+def test_handler_sqs_message_content(mock_send_message, mock_get_object, mock_put_object, s3_event, mock_s3_response, mock_sqs_response):
     """Test that SQS message content send by the handler"""
 
     mock_get_object.return_value = mock_s3_response
@@ -65,14 +71,256 @@ def test_handler_sqs_message_content(mock_send_message, mock_get_object, s3_even
     sent_messages = []
     for call in mock_send_message.call_args_list:
         kwargs = call.kwargs
-        message_body = json.loads(kwargs['MessageBody'])
-        sent_messages.append(message_body)
+        for entry in kwargs['Entries']:
+            sent_messages.append(json.loads(entry['MessageBody']))
 
     # Verify the message structure for all sent messages
     for message in sent_messages:
-        assert isinstance(message, dict), "Each message should be a dictionary"
-        assert 'test_case' in message, "Each message should have a 'test_case' key"
-        assert 'step' in message, "Each message should have a step field"
+        assert isinstance(message, list), "Each message should be a list of test cases"
+        for test_case in message:
+            for step in test_case:
+                assert 'test_case' in step, "Each step should have a 'test_case' key"
+                assert 'step' in step, "Each step should have a step field"
+
+def _test_case(test_number, steps, bot_id='BOT'):
+    return [{'test_case': str(test_number), 'step': str(i + 1), 'bot_id': bot_id} for i in range(steps)]
+
+def test_estimate_uses_historical_latency_per_bot():
+    """Test that bots with latency stats use them and others fall back to the default"""
+    latencies = {'default': 0.5, 'SLOW': 2.0}
+
+    assert estimate_test_case_seconds(_test_case(1, 3, 'SLOW'), latencies) == 6.0
+    assert estimate_test_case_seconds(_test_case(2, 3, 'OTHER'), latencies) == 1.5
+
+def test_pack_test_cases_fits_budget_longest_first():
+    """Test that messages stay within budget, are balanced and are sent longest first"""
+    grouped_tests = {'1': _test_case(1, 40)}
+    for i in range(2, 22):
+        grouped_tests[str(i)] = _test_case(i, 1)
+
+    messages = pack_test_cases(grouped_tests.values(), {'default': 1.0}, budget=8)
+
+    # the 40 step conversation can't be split and goes first, on its own
+    assert messages[0][0] == 40
+    assert len(messages[0][1]) == 1
+    # the twenty single step conversations are spread over three messages
+    assert [estimate for estimate, _ in messages[1:]] == [7, 7, 6]
+    assert sum(len(test_cases) for _, test_cases in messages) == 21
+
+@pytest.fixture
+def template():
+    """Fixture providing a two step template test case"""
+    return [
+        {'test_case': '5', 'step': '1', 'utterance': 'I live in {city}', 'expected_intent': 'AddressIntent'},
+        {'test_case': '5', 'step': '2', 'utterance': 'send {count} pamphlets to {city}', 'expected_intent': 'OrderIntent'},
+    ]
+
+def test_expand_template_full_product(template):
+    """Test that a template expands lazily to every combination with stable test_case ids"""
+    values = {'city': ['Boston', 'Denver', 'Austin'], 'count': ['1', '2']}
+
+    expanded = expand_template(template, values)
+
+    assert not isinstance(expanded, list)
+    expanded = list(expanded)
+    assert len(expanded) == 6
+    assert expanded[1][0]['utterance'] == 'I live in Boston'
+    assert expanded[1][1]['utterance'] == 'send 2 pamphlets to Boston'
+    assert [test_case[0]['test_case'] for test_case in expanded] == [f'5-{i}' for i in range(6)]
+
+def test_expand_template_random_sampling(template):
+    """Test that random sampling caps the number of cases without repeating any"""
+    values = {'city': [f'city {i}' for i in range(500)], 'count': [str(i) for i in range(100)]}
+
+    expanded = list(expand_template(template, values, sampling='random', max_cases=20, seed=3))
+
+    assert len(expanded) == 20
+    assert len({test_case[0]['test_case'] for test_case in expanded}) == 20
+
+def test_pairwise_combinations_cover_every_pair():
+    """Test that pairwise sampling covers every pair of values with far fewer cases than the product"""
+    sizes = [5, 4, 3, 3]
+
+    combinations = pairwise_combinations(sizes)
+
+    assert len(combinations) < 5 * 4 * 3 * 3
+    for i in range(len(sizes)):
+        for j in range(i + 1, len(sizes)):
+            pairs = {(combination[i], combination[j]) for combination in combinations}
+            assert len(pairs) == sizes[i] * sizes[j]
+
+@patch('lambdas.initializer.index.sqs_client')
+def test_send_messages_batches_of_ten(mock_sqs_client):
+    """Test that messages are sent ten to a batch and rejected entries are retried"""
+    mock_sqs_client.send_message_batch.return_value = {'Failed': [{'Id': '3', 'Message': 'throttled'}]}
+
+    sent = send_messages(('queue', f'body {i}') for i in range(25))
+
+    assert sent == 25
+    assert [len(call.kwargs['Entries']) for call in mock_sqs_client.send_message_batch.call_args_list] == [10, 10, 5]
+    assert mock_sqs_client.send_message.call_count == 3
+
+@patch('lambdas.initializer.index.sqs_client')
+def test_send_messages_batches_per_queue(mock_sqs_client):
+    """Test that messages for different queues are batched apart"""
+    mock_sqs_client.send_message_batch.return_value = {}
+
+    sent = send_messages((queue, f'body {i}') for i in range(12) for queue in ('queue', 'lane'))
+
+    assert sent == 24
+    batches = [(call.kwargs['QueueUrl'], len(call.kwargs['Entries'])) for call in mock_sqs_client.send_message_batch.call_args_list]
+    assert sorted(batches) == [('lane', 2), ('lane', 10), ('queue', 2), ('queue', 10)]
+
+@patch('lambdas.initializer.index.BATCHES_PART_BYTES', 100)
+@patch('lambdas.initializer.index.s3_client')
+def test_write_batches_aborts_a_failed_upload(mock_s3_client):
+    """Test that batches are uploaded in parts as they are packed, and a failed upload is aborted"""
+    mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+    mock_s3_client.upload_part.return_value = {'ETag': '"etag"'}
+
+    def bodies():
+        yield from ('x' * 100 for _ in range(3))
+        raise RuntimeError('packing failed')
+
+    with pytest.raises(RuntimeError):
+        write_batches('bucket', 'run', bodies())
+
+    assert mock_s3_client.upload_part.call_count == 3
+    mock_s3_client.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='runs/batches/run.jsonl', UploadId='upload')
+    mock_s3_client.complete_multipart_upload.assert_not_called()
+    mock_s3_client.put_object.assert_not_called()
+
+@patch('lambdas.initializer.index.lex_models_client')
+def test_changed_intents_between_versions(mock_lex_models_client):
+    """Test that intents added, removed or redefined between bot versions are selected"""
+    versions = {
+        '1': {'Greeting': ['hi'], 'Order': ['order a pamphlet'], 'Retired': ['bye']},
+        '2': {'Greeting': ['hi'], 'Order': ['order a pamphlet', 'send me a pamphlet'], 'Transfer': ['agent']},
+    }
+    mock_lex_models_client.list_intents.side_effect = lambda botVersion, **kwargs: {
+        'intentSummaries': [{'intentId': name, 'intentName': name} for name in versions[botVersion]]
+    }
+    mock_lex_models_client.describe_intent.side_effect = lambda intentId, botVersion, **kwargs: {
+        'intentName': intentId, 'sampleUtterances': versions[botVersion][intentId], 'botVersion': botVersion,
+    }
+
+    assert changed_intents('BOT', 'en_US', '1', '2') == {'Order', 'Retired', 'Transfer'}
+
+@patch('lambdas.initializer.index.PROCESSOR_TIMEOUT_SECONDS', 30)
+def test_within_timeout_leaves_out_cases_longer_than_the_processor_timeout():
+    """Test that a conversation the processor can't finish before timing out is reported instead of queued"""
+    oversized = []
+
+    kept = list(within_timeout([_test_case(1, 40), _test_case(2, 30)], {'default': 1.0}, oversized))
+
+    assert [test_case[0]['test_case'] for test_case in kept] == ['2']
+    assert oversized == ['1']
+
+def test_read_rows_zstd_csv():
+    """Test that zstd compressed suites are detected by their magic bytes"""
+    zstandard = pytest.importorskip('zstandard')
+
+    content = 'test_case,step,utterance\n1,1,hello\n1,2,bye\n'
+    rows = list(read_rows(BytesIO(zstandard.ZstdCompressor().compress(content.encode('utf-8'))), 'suite'))
+
+    assert [row['utterance'] for row in rows] == ['hello', 'bye']
+
+def test_read_rows_parquet():
+    """Test that Parquet suites are read with string values, whatever their column types"""
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+
+    output = BytesIO()
+    pq.write_table(pa.table({'test_case': [1, 1], 'step': [1, 2], 'Utterance': ['hello', None]}), output)
+    rows = list(read_rows(BytesIO(output.getvalue()), 'suites/suite.parquet'))
+
+    assert rows == [{'test_case': '1', 'step': '1', 'utterance': 'hello'}, {'test_case': '1', 'step': '2', 'utterance': ''}]
+
+def _rows(*test_numbers, s3_path=None):
+    return [{'test_case': test_number, 's3_path': s3_path} for test_number in test_numbers]
+
+def test_is_sorted_in_natural_order():
+    """Test that test_case ids are compared by number, and a manifest's suites are sorted on their own"""
+    assert is_sorted(_rows('1', '1', '2', '10', 'a/2', 'a/10'))
+    assert not is_sorted(_rows('1', '2', '1'))
+    assert is_sorted(_rows('b/1', 'b/2', s3_path='s3://b') + _rows('a/1', s3_path='s3://a'))
+
+def test_group_test_cases_sorted_and_unsorted():
+    """Test that both sorted and unsorted rows end up grouped by test case"""
+    rows = [{'test_case': test_number, 'step': step} for test_number, step in [('1', '1'), ('1', '2'), ('2', '1')]]
+    shuffled = [rows[0], rows[2], rows[1]]
+
+    assert [len(test_case) for test_case in group_test_cases(iter(rows), sorted_rows=True)] == [2, 1]
+    assert [len(test_case) for test_case in group_test_cases(iter(shuffled), sorted_rows=False)] == [2, 1]
+
+@patch('lambdas.initializer.index.s3_client')
+@patch('lambdas.initializer.index.sqs_client.send_message_batch')
+def test_manifest_options_apply_unless_the_event_overrides_them(mock_send_message, mock_s3_client, mock_sqs_response):
+    """Test that a manifest's options are used for the run, with the event's options taking precedence"""
+
+    suite = 'test_case,step,utterance,bot_id\n1,1,hello,BOT\n'
+    manifest = {'suites': ['suites/a.csv'], 'options': {'fail_fast': True, 'lex_mode': 'record'}}
+    objects = {'nightly.manifest.json': json.dumps(manifest).encode('utf-8'), 'suites/a.csv': suite.encode('utf-8')}
+    mock_s3_client.get_object.side_effect = lambda Bucket, Key, **kwargs: {'Body': BytesIO(objects[Key])}
+    mock_s3_client.head_object.return_value = {'ETag': '"etag"'}
+    mock_send_message.return_value = mock_sqs_response
+
+    handler({'s3_path': 's3://test-bucket/nightly.manifest.json', 'lex_mode': 'live'}, None)
+
+    step = json.loads(mock_send_message.call_args.kwargs['Entries'][0]['MessageBody'])[0][0]
+    assert step['fail_fast'] is True
+    assert step['lex_mode'] == 'live'
+    assert step['s3_path'] == 's3://test-bucket/suites/a.csv'
+
+def test_read_rows_gzip_csv_normalizes_headers():
+    """Test that a gzipped suite using the docs template headers is read with pipeline field names"""
+
+    content = 'Test Case,Step,Utterance,BotId,AliasId,LocaleId\n1,1,hello,BOT,ALIAS,en_US\n'
+    rows = list(read_rows(BytesIO(gzip.compress(content.encode('utf-8-sig'))), 'suites/suite.csv'))
+
+    assert rows == [{'test_case': '1', 'step': '1', 'utterance': 'hello', 'bot_id': 'BOT', 'alias_id': 'ALIAS', 'locale_id': 'en_US'}]
+
+def test_read_rows_json_lines():
+    """Test that JSON Lines suites are read row by row, with session attributes given as an object"""
+
+    content = '{"test_case": 1, "step": 1, "utterance": "hi", "session_attributes": {"channel": "web"}, "notes": null}\n\n'
+    rows = list(read_rows(BytesIO(content.encode('utf-8')), 'suite.jsonl'))
+
+    assert rows == [{'test_case': '1', 'step': '1', 'utterance': 'hi', 'session_attributes': 'channel=web,', 'notes': ''}]
+
+def test_expand_targets_copies_every_case_per_target():
+    """Test that each test case is queued once per target, with the target's ids"""
+
+    targets = [{'alias_id': 'PROD'}, {'alias_id': 'TEST', 'locale_id': 'en_GB', 'name': 'uk'}]
+    expanded = list(expand_targets([_test_case(1, 2), _test_case(2, 1)], targets))
+
+    assert [test_case[0]['test_case'] for test_case in expanded] == ['1@PROD', '1@uk', '2@PROD', '2@uk']
+    assert expanded[1][1] == {'test_case': '1@uk', 'step': '2', 'bot_id': 'BOT', 'alias_id': 'TEST', 'locale_id': 'en_GB', 'target': 'uk'}
+
+def test_prewarm_concurrency_from_throughput_target():
+    """Test that pre-warming is sized to the throughput target, but never beyond the run's messages"""
+    # 100 cases of 2 seconds, 200 seconds of work
+    assert prewarm_concurrency(100, 200.0, cases_per_second=5) == 10
+    # 25 messages of 8 seconds at most
+    assert prewarm_concurrency(100, 200.0, cases_per_second=100) == 25
+    assert prewarm_concurrency(0, 0.0, cases_per_second=5) == 0
+
+@patch('lambdas.initializer.index.PACK_WINDOW', 40)
+@patch('lambdas.initializer.index.prewarm_processor', side_effect=lambda concurrency: concurrency)
+def test_prewarm_ahead_warms_each_window_before_passing_it_on(mock_prewarm_processor):
+    """Test that containers are started for the cases seen so far before they are passed on to be queued"""
+    test_cases = (_test_case(i, 2) for i in range(100))
+    warmups = []
+
+    passed = []
+    for test_case in prewarm_ahead(test_cases, {'default': 1.0}, 100, warmups):
+        passed.append(test_case)
+        # the window a case is in was warmed for before it was passed on
+        assert sum(warmups) == min(25, math.ceil(len(passed) / 40) * 10)
+
+    assert len(passed) == 100
+    # 10, 20 then 25 messages of 8 seconds
+    assert warmups == [10, 10, 5]
 
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -1,9 +1,13 @@
 import os
+import gzip
+from io import BytesIO
 from unittest.mock import patch
 import json
+import threading
+import time
 import pytest
 
-from lambdas.processor.index import handler
+from lambdas.processor.index import handler, parse_message, execute_test_case, process_test_cases
 
 
 os.environ['QUEUE_URL'] = 'https://sqs.us-east-1.amazonaws.com/123456789012/fake-queue-url'
@@ -54,10 +58,8 @@ def mock_lex_response():
     return {
         'messages': [{'content': 'Hi'}],
         'sessionState': {
-            'intent': {
-                    'intent': {'name': 'GreetingIntent', 'state': 'Fulfilled'},
-                    'sessionAttributes': {'key': 'value'}
-                }
+            'intent': {'name': 'GreetingIntent', 'state': 'Fulfilled'},
+            'sessionAttributes': {'key': 'value'}
             }
         }
 
@@ -78,33 +80,171 @@ def expected_firehose_data():
         'response': 'Hi',
         'actual_intent': 'GreetingIntent',
         'actual_state': 'Fulfilled',
-        'test_result': None,
-        'test_explanation': None
+        'test_result': '',
+        'test_explanation': ''
     }
 
+@patch('lambdas.processor.index.s3_client')
 @patch('lambdas.processor.index.sqs_client')
 @patch('lambdas.processor.index.firehose_client')
 @patch('lambdas.processor.index.lex_client')
-def test_handler(mock_lex_client, mock_firehose_client, mock_sqs_client, sqs_event, mock_lex_response, expected_firehose_data):
+def test_handler(mock_lex_client, mock_firehose_client, mock_sqs_client, mock_s3_client, sqs_event, mock_lex_response, expected_firehose_data):
     """Test that the handler processes the event correctly"""
 
-    # Call the lambda handler
-    handler(sqs_event, None)
-
     # Setup mocks
     mock_lex_client.recognize_text.return_value = mock_lex_response
+    mock_firehose_client.put_record_batch.return_value = {'FailedPutCount': 0}
 
+    # Call the lambda handler
     handler(sqs_event, None)
 
     # Assertions
-    mock_lex_client.recognize_text.assert_called_once_with(
-        DeliveryStreemName=os.environ['FIREHOSE_NAME'],
-        Record={'Data': json.dumps(expected_firehose_data) + '\n'}
-    )
+    mock_lex_client.recognize_text.assert_called_once()
+    records = mock_firehose_client.put_record_batch.call_args.kwargs['Records']
+    assert len(records) == 1
+    assert records[0]['Data'].endswith('\n')
+    data = json.loads(records[0]['Data'])
+    assert {key: data[key] for key in expected_firehose_data} == expected_firehose_data
+    assert 'lex_latency_ms' in data
     mock_sqs_client.delete_message.assert_called_once_with(
         QueueUrl=os.environ['QUEUE_URL'],
         ReceiptHandle='mockReceiptHandle'
     )
+    index = json.loads(gzip.decompress(mock_s3_client.put_object.call_args.kwargs['Body']))
+    assert index['1']['1'][1:4] == ['GreetingIntent', '', 0]
+
+@patch('lambdas.processor.index.s3_client')
+@patch('lambdas.processor.index.sqs_client')
+@patch('lambdas.processor.index.firehose_client')
+@patch('lambdas.processor.index.lex_client')
+def test_handler_isolates_failing_message(mock_lex_client, mock_firehose_client, mock_sqs_client, mock_s3_client, sqs_event, mock_lex_response):
+    """Test that a malformed message fails on its own, and is retried while the others are deleted"""
+
+    mock_lex_client.recognize_text.return_value = mock_lex_response
+    mock_firehose_client.put_record_batch.return_value = {'FailedPutCount': 0}
+    malformed = dict(sqs_event['Records'][0], messageId='malformed', receiptHandle='malformedReceiptHandle', body='[{"Step": "1"}]',
+                     attributes={'ApproximateReceiveCount': '1'})
+    sqs_event['Records'].append(malformed)
+
+    with pytest.raises(RuntimeError, match='1 of 2 messages failed: malformed: KeyError'):
+        handler(sqs_event, None)
+
+    assert len(mock_firehose_client.put_record_batch.call_args.kwargs['Records']) == 1
+    mock_sqs_client.delete_message.assert_called_once_with(QueueUrl=os.environ['QUEUE_URL'], ReceiptHandle='mockReceiptHandle')
+
+@patch('lambdas.processor.index.DLQ_URL', 'https://sqs.us-east-1.amazonaws.com/123456789012/fake-dlq-url')
+@patch('lambdas.processor.index.s3_client')
+@patch('lambdas.processor.index.sqs_client')
+@patch('lambdas.processor.index.firehose_client')
+def test_handler_dead_letters_on_last_receive(mock_firehose_client, mock_sqs_client, mock_s3_client, sqs_event):
+    """Test that a message failing its last allowed receive goes to the dead-letter queue with the reason"""
+
+    sqs_event['Records'][0]['body'] = 'not json'
+
+    handler(sqs_event, None)
+
+    kwargs = mock_sqs_client.send_message.call_args.kwargs
+    assert kwargs['QueueUrl'].endswith('fake-dlq-url')
+    assert kwargs['MessageBody'] == 'not json'
+    assert kwargs['MessageAttributes']['failure_type']['StringValue'] == 'JSONDecodeError'
+    assert kwargs['MessageAttributes']['receive_count']['StringValue'] == '13'
+    mock_sqs_client.delete_message.assert_called_once()
+
+def test_parse_message_packed_and_single():
+    """Test that packed messages and single test_case messages both parse to a list of test_cases"""
+    steps = [{'test_case': '1', 'step': '1'}, {'test_case': '1', 'step': '2'}]
+
+    assert parse_message(json.dumps(steps)) == [steps]
+    assert parse_message(json.dumps([steps, steps[:1]])) == [steps, steps[:1]]
+
+@pytest.fixture
+def test_case():
+    """Fixture providing a two step test_case"""
+    return [
+        {'test_case': '7', 'step': str(i), 'utterance': f'utterance {i}', 'session_attributes': '',
+         'expected_response': '', 'expected_intent': 'GreetingIntent', 'bot_id': 'BOT', 'alias_id': 'ALIAS',
+         'locale_id': 'en_US', 'test_run': '2025-06-10T00:00:00'}
+        for i in (1, 2)
+    ]
+
+@patch('lambdas.processor.index.s3_client')
+@patch('lambdas.processor.index.lex_client')
+def test_record_then_replay(mock_lex_client, mock_s3_client, test_case, mock_lex_response):
+    """Test that a recorded test_case replays the same results without calling Lex"""
+
+    mock_lex_client.recognize_text.return_value = mock_lex_response
+    recorded = execute_test_case([dict(step, lex_mode='record') for step in test_case])
+
+    kwargs = mock_s3_client.put_object.call_args.kwargs
+    assert kwargs['Key'].endswith('/2025-06-10T00:00:00/7.json.gz')
+    exchanges = json.loads(gzip.decompress(kwargs['Body']))
+    assert [exchange['request']['text'] for exchange in exchanges] == ['utterance 1', 'utterance 2']
+
+    mock_lex_client.reset_mock()
+    mock_s3_client.get_object.return_value = {'Body': BytesIO(kwargs['Body'])}
+    replayed = execute_test_case([dict(step, lex_mode='replay', replay_run='2025-06-10T00:00:00') for step in test_case])
+
+    mock_lex_client.recognize_text.assert_not_called()
+    for recorded_step, replayed_step in zip(recorded, replayed):
+        for key in ('response', 'actual_intent', 'actual_state', 'lex_latency_ms'):
+            assert replayed_step[key] == recorded_step[key]
+
+@patch('lambdas.processor.index.s3_client')
+@patch('lambdas.processor.index.lex_client')
+def test_replay_without_cassette_reports_error(mock_lex_client, mock_s3_client, test_case):
+    """Test that replaying a test_case that was never recorded fails the first step"""
+
+    mock_s3_client.get_object.side_effect = Exception('NoSuchKey')
+    replayed = execute_test_case([dict(step, lex_mode='replay', replay_run='2025-06-09T00:00:00') for step in test_case])
+
+    mock_lex_client.recognize_text.assert_not_called()
+    assert 'No recorded Lex response' in replayed[0]['Error']
+    assert 'response' not in replayed[1]
+
+def test_replay_needs_replay_run(test_case):
+    """Test that replaying without naming the recorded run is refused rather than failing every step"""
+
+    with pytest.raises(ValueError, match='replay_run'):
+        execute_test_case([dict(step, lex_mode='replay') for step in test_case])
+
+@patch('lambdas.processor.index.lex_client')
+def test_fail_fast_skips_rest_of_conversation(mock_lex_client, test_case, mock_lex_response):
+    """Test that with fail_fast a conversation ends at its first failing step"""
+
+    # the bot recognizes GreetingIntent but the codehook grades the step as a failure
+    mock_lex_response['sessionState']['sessionAttributes']['test_result'] = 'Fail'
+    mock_lex_client.recognize_text.return_value = mock_lex_response
+
+    results = execute_test_case([dict(step, fail_fast=True) for step in test_case])
+
+    mock_lex_client.recognize_text.assert_called_once()
+    assert results[1]['test_result'] == 'Skipped'
+
+@patch('lambdas.processor.index.lex_client')
+def test_process_test_cases_runs_bots_side_by_side(mock_lex_client, test_case, mock_lex_response):
+    """Test that each bot gets its own workers, capped at its concurrency, and results keep their order"""
+
+    lock = threading.Lock()
+    in_flight = {}
+    peaks = {'total': 0}
+
+    def recognize_text(**request):
+        with lock:
+            in_flight[request['botId']] = in_flight.get(request['botId'], 0) + 1
+            peaks[request['botId']] = max(peaks.get(request['botId'], 0), in_flight[request['botId']])
+            peaks['total'] = max(peaks['total'], sum(in_flight.values()))
+        time.sleep(0.02)
+        with lock:
+            in_flight[request['botId']] -= 1
+        return mock_lex_response
+
+    mock_lex_client.recognize_text.side_effect = recognize_text
+    test_cases = [[dict(step, test_case=f'{bot_id}-{n}', bot_id=bot_id) for step in test_case] for n in range(3) for bot_id in ('SLOW', 'FAST')]
+
+    _, results = process_test_cases(test_cases)
+
+    assert [test_case[0]['test_case'] for test_case in results] == [test_case[0]['test_case'] for test_case in test_cases]
+    assert peaks == {'SLOW': 1, 'FAST': 1, 'total': 2}
 
 if __name__ == '__main__':
     pytest.main([__file__])
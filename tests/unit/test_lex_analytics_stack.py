@@ -1,15 +1,108 @@
+import json
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
+
+from infastructure.config import AppConfig
+from infastructure.project_stack import LexTestTool
+
+
+def synth(**kwargs) -> assertions.Template:
+    # the initializer's dependencies are only bundled for a deployment. Feature flags set in cdk.json
+    app = core.App(context={'aws:cdk:bundling-stacks': [], '@aws-cdk/aws-stepfunctions:useDistributedMapResultWriterV2': True})
+    stack = LexTestTool(app, "LexTestTool-East", AppConfig(account='123456789012', region='us-east-1', **kwargs))
+    return assertions.Template.from_stack(stack)
+
+@pytest.fixture(scope='module')
+def template():
+    """Fixture providing the stack synthesized with the default (SQS) orchestration"""
+    return synth()
+
+def definition(template: assertions.Template) -> str:
+    """The state machine definition, with its references left as JSON"""
+    state_machine = next(iter(template.find_resources("AWS::StepFunctions::StateMachine").values()))
+    return json.dumps(state_machine['Properties']['DefinitionString'])
+
+def rule_targets(template: assertions.Template) -> list[dict]:
+    rule = next(iter(template.find_resources("AWS::Events::Rule").values()))
+    return rule['Properties']['Targets']
+
+def test_test_queue_has_dead_letter_queue(template):
+    template.resource_count_is("AWS::SQS::Queue", 2)
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "QueueName": "lex-analytics-test-queue",
+        "RedrivePolicy": {"maxReceiveCount": 3, "deadLetterTargetArn": assertions.Match.any_value()},
+    })
+
+def test_visibility_timeout_outlasts_processor(template):
+    template.has_resource_properties("AWS::Lambda::Function", {"FunctionName": "lex-analytics-processor", "Timeout": 120})
+    template.has_resource_properties("AWS::SQS::Queue", {"QueueName": "lex-analytics-test-queue", "VisibilityTimeout": 720})
+
+def test_initializer_is_bundled_as_an_asset(template):
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "lex-analytics-initializer",
+        "Code": {"S3Bucket": assertions.Match.any_value(), "S3Key": assertions.Match.any_value()},
+    })
+
+def test_initializer_is_sized_for_large_suites(template):
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "lex-analytics-initializer",
+        "MemorySize": 1024,
+        "EphemeralStorage": {"Size": 2048},
+    })
+
+def test_latency_stats_are_only_read_when_configured(template):
+    initializer = template.find_resources("AWS::Lambda::Function", {"Properties": {"FunctionName": "lex-analytics-initializer"}})
+    assert 'LATENCY_STATS_KEY' not in next(iter(initializer.values()))['Properties']['Environment']['Variables']
+
+    template = synth(latency_stats_key='lex-analytics/stats/step_latency.json')
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "lex-analytics-initializer",
+        "Environment": {"Variables": assertions.Match.object_like({"LATENCY_STATS_KEY": "lex-analytics/stats/step_latency.json"})},
+    })
+
+def test_state_machine_runs_processor_in_distributed_map(template):
+    template.resource_count_is("AWS::StepFunctions::StateMachine", 1)
+    states = definition(template)
+    assert '\\"Mode\\":\\"DISTRIBUTED\\"' in states
+    assert '\\"ExecutionType\\":\\"EXPRESS\\"' in states
+    assert '\\"MaxConcurrency\\":50' in states
+    assert '\\"ToleratedFailurePercentage\\":5' in states
+    assert '\\"InputType\\":\\"JSONL\\"' in states
+    # the batches the initializer wrote for this run are read from the paths it returned
+    assert '\\"Bucket.$\\":\\"$.batches_bucket\\"' in states
+    assert '\\"ResultWriter\\"' in states
+
+def test_sqs_orchestration_triggers_initializer(template):
+    targets = rule_targets(template)
+    assert len(targets) == 1
+    assert 'initializerLambda' in json.dumps(targets[0]['Arn'])
+
+def test_stepfunctions_orchestration_triggers_state_machine():
+    template = synth(orchestration='stepfunctions', map_max_concurrency=10)
 
-from lex_analytics.lex_analytics_stack import LexAnalyticsStack
+    targets = rule_targets(template)
+    assert len(targets) == 1
+    assert 'TestRunStateMachine' in json.dumps(targets[0]['Arn'])
+    assert '\\"MaxConcurrency\\":10' in definition(template)
+    # the SQS path stays deployed
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 1)
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in lex_analytics/lex_analytics_stack.py
-def test_sqs_queue_created():
-    app = core.App()
-    stack = LexAnalyticsStack(app, "lex-analytics")
-    template = assertions.Template.from_stack(stack)
+def test_bot_lanes_cap_each_bot_across_the_fleet():
+    template = synth(bot_lanes={'BOTA': 5, 'BOTB': 1})
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+    template.resource_count_is("AWS::SQS::Queue", 4)
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "QueueName": "lex-analytics-test-queue-bota",
+        "VisibilityTimeout": 720,
+        "RedrivePolicy": {"maxReceiveCount": 3, "deadLetterTargetArn": assertions.Match.any_value()},
+    })
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 3)
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {"ScalingConfig": {"MaximumConcurrency": 5}})
+    # the minimum SQS allows
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {"ScalingConfig": {"MaximumConcurrency": 2}})
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": "lex-analytics-initializer",
+        "Environment": {"Variables": assertions.Match.object_like({"LANE_QUEUE_URLS": assertions.Match.any_value()})},
+    })